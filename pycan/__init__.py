@@ -11,7 +11,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from .pyisotp import ISOTP
+from .pyisotp import ISOTP, AdaptiveFlowControl
+from .asyncisotp import AsyncISOTP
+from .dispatcher import ISOTPDispatcher
+from .scheduler import TxScheduler
 from .pyuds import UDS
 
-from .datatypes import CanMessage
+from .datatypes import CanMessage, CanFrameRing
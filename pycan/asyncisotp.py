@@ -0,0 +1,182 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import asyncio
+from collections.abc import AsyncIterable
+from .datatypes import CanMessage
+from .pacing import decodeSTmin
+from .pyisotp import ISOTP, ISOTPTransfer
+from time import monotonic
+
+
+class AsyncISOTP(ISOTP):
+    _queueType = asyncio.Queue
+
+    def __init__(self, send, **kwargs):
+        # Frames are pushed through feed() or run(), there is no recv callback
+        super().__init__(None, send, **kwargs)
+        self._timers = {}
+
+    async def run(self, source: AsyncIterable[CanMessage]):
+        async for msg in source:
+            self.feed(msg)
+
+    async def recv(self, timeout=2, id=None, extended=None):
+        if None == id:
+            id = self._rxid
+
+        if None == extended:
+            extended = self._extended
+
+        session = self._session(id, extended)
+
+        data = await self._wait(session.pdus, timeout, id)
+
+        # The application made room, let a paused sender continue
+        if session.waiting and 0 == self._adaptive.status(session):
+            self._flowControl(session, monotonic())
+
+        return data
+
+    async def send(self, data, timeout=None, id=None, extended=None, fd=None):
+        extended = extended or self._extended
+        fd = fd or self._fd
+
+        if None == id:
+            id = self._txid
+
+        # Each FC wait is bounded by timeout, N_Bs unless given
+        if None == timeout:
+            timeout = self._nBs
+
+        # Drop any stale FC left over from a previous transfer
+        session = self._sender(id, extended)
+        while not session.flowControl.empty():
+            session.flowControl.get_nowait()
+
+        if self._sendFn:
+            await self._sendTransfer(ISOTPTransfer(data, fd, self._pool),
+                                     id, extended, fd, session, timeout)
+
+# private
+    async def _sendTransfer(self, transfer, id, extended, fd, session, timeout):
+        loop = asyncio.get_running_loop()
+
+        self._sendFn(id, extended, fd, transfer.firstFrame())
+
+        if transfer.done:
+            return
+
+        # wait for flow control
+        flags, blockSize, separationTime = await self._waitForFlowControl(
+            timeout, session)
+        interval = decodeSTmin(separationTime)
+        deadline = loop.time()
+        paced = []
+
+        blockCount = 0
+        while not transfer.done:
+            if blockSize != 0 and blockCount == blockSize:
+                blockCount = 0
+                # wait for flow control
+                flags, blockSize, separationTime = await self._waitForFlowControl(
+                    timeout, session)
+                self._observePaced(session, interval, paced)
+                interval = decodeSTmin(separationTime)
+                deadline = loop.time()
+
+            if 0 == interval:
+                count = self._maxBurst
+                if 0 != blockSize:
+                    count = min(count, blockSize - blockCount)
+
+                frames = transfer.nextFrames(count)
+                if self._sendManyFn:
+                    self._sendManyFn(id, extended, fd, frames)
+                else:
+                    for frame in frames:
+                        self._sendFn(id, extended, fd, frame)
+
+                blockCount += len(frames)
+
+                # Let the other channels on this loop run between bursts
+                await asyncio.sleep(0)
+                continue
+
+            delay = deadline - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            self._sendFn(id, extended, fd, transfer.nextFrame())
+            deadline = loop.time() + interval
+
+            if self._observer:
+                paced.append(deadline)
+
+            blockCount += 1
+
+        self._observePaced(session, interval, paced)
+
+    async def _waitForFlowControl(self, timeout, session):
+
+        while 1:
+            start = monotonic()
+            flag, blockSize, separationTime = await self._wait(
+                session.flowControl, timeout, session.rxid)
+
+            if self._observer:
+                self._observer.flowControl((session.txid, session.rxid),
+                                           flag, monotonic() - start)
+
+            # Wait, the receiver restarts our N_Bs timer
+            if 1 == flag:
+                continue
+            # Overflow
+            elif 2 == flag:
+                raise Exception("Flow control overflow")
+
+            return flag, blockSize, separationTime
+
+    async def _wait(self, queue, timeout, id):
+        try:
+            return await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            raise Exception("Rx Timeout")
+
+    def _observePaced(self, session, interval, paced):
+        if len(paced) > 1:
+            self._observer.separationTime((session.txid, session.rxid), interval,
+                                          (paced[-1] - paced[0]) / (len(paced) - 1))
+        paced.clear()
+
+    def _process(self, session, payload, now):
+        super()._process(session, payload, now)
+
+        if (session.active or session.waiting) and session not in self._timers:
+            self._arm(session, self._nCr)
+
+    def _arm(self, session, delay):
+        loop = asyncio.get_running_loop()
+        self._timers[session] = loop.call_later(delay, self._expire, session)
+
+    def _expire(self, session):
+        del self._timers[session]
+
+        now = monotonic()
+        self._checkSession(session, now)
+
+        # Frames only refresh lastRx, re-arm for whatever is left of N_Cr
+        if session.waiting:
+            self._arm(session, self._adaptive.waitInterval)
+        elif session.active:
+            self._arm(session, max(0, self._nCr - (now - session.lastRx)))
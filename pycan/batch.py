@@ -0,0 +1,155 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+from .datatypes import CanMessage
+from .offline import reassemble
+from .trace import FLAG_EXTENDED, FLAG_FD, FLAG_TX
+
+PAYLOAD_SIZE = 64
+
+
+class CanFrameBatch(object):
+    # Frames as columns: one array per field and a fixed width payload
+    # matrix. Slicing with a slice returns views, any other index copies.
+    def __init__(self, timestamps, ids, flags, dlcs, payloads):
+        self.timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.ids = np.asarray(ids, dtype=np.uint32)
+        self.flags = np.asarray(flags, dtype=np.uint8)
+        self.dlcs = np.asarray(dlcs, dtype=np.uint8)
+        self.payloads = np.asarray(payloads, dtype=np.uint8).reshape(-1, PAYLOAD_SIZE)
+
+    @classmethod
+    def empty(cls, count: int = 0):
+        return cls(np.zeros(count), np.zeros(count), np.zeros(count),
+                   np.zeros(count), np.zeros((count, PAYLOAD_SIZE)))
+
+    @classmethod
+    def fromMessages(cls, msgs, tx: bool = False):
+        msgs = list(msgs)
+        count = len(msgs)
+
+        timestamps = np.empty(count, dtype=np.float64)
+        ids = np.empty(count, dtype=np.uint32)
+        flags = np.empty(count, dtype=np.uint8)
+        dlcs = np.empty(count, dtype=np.uint8)
+        payloads = bytearray(count * PAYLOAD_SIZE)
+
+        txFlag = FLAG_TX if tx else 0
+        offset = 0
+        for i, msg in enumerate(msgs):
+            size = len(msg.payload)
+            timestamps[i] = msg.time or 0
+            ids[i] = msg.arbitrationId
+            flags[i] = ((FLAG_EXTENDED if msg.isExtended else 0)
+                        | (FLAG_FD if msg.isFd else 0) | txFlag)
+            dlcs[i] = size
+            payloads[offset: offset + size] = msg.payload
+            offset += PAYLOAD_SIZE
+
+        return cls(timestamps, ids, flags, dlcs,
+                   np.frombuffer(payloads, dtype=np.uint8))
+
+    @classmethod
+    def fromTrace(cls, replayer, start: int = 0, stop: int = None):
+        if None == stop:
+            stop = len(replayer)
+
+        msgs = []
+        tx = []
+        for number in range(start, stop):
+            msg, flags = replayer._read(replayer._offsets[number])
+            msgs.append(msg)
+            tx.append(bool(flags & FLAG_TX))
+
+        batch = cls.fromMessages(msgs)
+        batch.flags |= np.asarray(tx, dtype=np.uint8) * FLAG_TX
+
+        return batch
+
+    @classmethod
+    def concatenate(cls, batches):
+        batches = list(batches)
+        return cls(np.concatenate([b.timestamps for b in batches]),
+                   np.concatenate([b.ids for b in batches]),
+                   np.concatenate([b.flags for b in batches]),
+                   np.concatenate([b.dlcs for b in batches]),
+                   np.concatenate([b.payloads for b in batches]))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self._message(int(key))
+
+        return CanFrameBatch(self.timestamps[key], self.ids[key], self.flags[key],
+                             self.dlcs[key], self.payloads[key])
+
+    def __iter__(self):
+        extended = (self.flags & FLAG_EXTENDED).astype(bool).tolist()
+        fd = (self.flags & FLAG_FD).astype(bool).tolist()
+
+        # Whole columns to Python in one go, then one slice per frame
+        for i, (timestamp, id, dlc) in enumerate(zip(self.timestamps.tolist(),
+                                                     self.ids.tolist(),
+                                                     self.dlcs.tolist())):
+            yield CanMessage(timestamp, id, extended[i],
+                             self.payloads[i, :dlc].tobytes(), fd[i])
+
+    @property
+    def extended(self):
+        return (self.flags & FLAG_EXTENDED) != 0
+
+    @property
+    def fd(self):
+        return (self.flags & FLAG_FD) != 0
+
+    @property
+    def tx(self):
+        return (self.flags & FLAG_TX) != 0
+
+    def toMessages(self) -> list:
+        return list(self)
+
+    def filterIds(self, ids, extended: bool = None):
+        return self[self._match(np.isin(self.ids, np.asarray(ids, dtype=np.uint32)),
+                                extended)]
+
+    def filterMask(self, id: int, mask: int, extended: bool = None):
+        return self[self._match((self.ids & mask) == (id & mask), extended)]
+
+    def window(self, start: float = None, stop: float = None):
+        # Frames are in time order, so the window is a view
+        first = 0 if start is None else int(np.searchsorted(self.timestamps, start, 'left'))
+        last = len(self) if stop is None else int(np.searchsorted(self.timestamps, stop, 'left'))
+
+        return self[first:last]
+
+    def reassemble(self, nCr: float = None):
+        return reassemble(self.ids, self.dlcs, self.payloads, self.extended,
+                          self.timestamps, nCr)
+
+# private
+    def _message(self, i):
+        flags = self.flags[i]
+        return CanMessage(float(self.timestamps[i]), int(self.ids[i]),
+                          bool(flags & FLAG_EXTENDED),
+                          self.payloads[i, :self.dlcs[i]].tobytes(),
+                          bool(flags & FLAG_FD))
+
+    def _match(self, selected, extended):
+        if None != extended:
+            selected &= self.extended == extended
+
+        return selected
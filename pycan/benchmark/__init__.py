@@ -0,0 +1,179 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import platform
+import statistics
+from ..pyuds import UDS
+from .ecu import SimulatedECU
+from .loopback import loopbackPair
+from time import perf_counter, time
+
+ISOTP_SIZES = [8, 64, 512, 4095, 16384, 65536]
+
+
+def _latencyStats(samples):
+    samples = sorted(samples)
+    count = len(samples)
+
+    return {
+        'count': count,
+        'mean_s': statistics.fmean(samples),
+        'median_s': statistics.median(samples),
+        'p95_s': samples[min(count - 1, int(count * 0.95))],
+        'p99_s': samples[min(count - 1, int(count * 0.99))],
+        'min_s': samples[0],
+        'max_s': samples[-1],
+    }
+
+
+def _udsPair(fd, bitrate, dataBitrate, pending=0, maxBlockLength=0xFFF):
+    tester, ecuTp, close = loopbackPair(fd, bitrate, dataBitrate)
+    ecu = SimulatedECU(ecuTp, pending, maxBlockLength)
+    uds = UDS(rxid=0x718, txid=0x710, extended=False,
+              recv=tester.recv, send=tester.send, fd=fd)
+
+    return uds, ecu, close
+
+
+def isotpThroughput(fd: bool, size: int, duration: float = 1.0,
+                    bitrate: int = None, dataBitrate: int = None):
+    tester, ecu, close = loopbackPair(fd, bitrate, dataBitrate)
+    data = bytes(i & 0xFF for i in range(size))
+
+    # Receive every PDU on the other side so both segmentation and
+    # reassembly are measured
+    iterations = 0
+    start = perf_counter()
+    try:
+        while 1:
+            tester.send(data)
+            if ecu.recv(5) != data:
+                raise Exception("Loopback mismatch")
+
+            iterations += 1
+            elapsed = perf_counter() - start
+            if elapsed >= duration:
+                break
+    finally:
+        close()
+
+    return {
+        'iterations': iterations,
+        'elapsed_s': elapsed,
+        'pdus_per_s': iterations / elapsed,
+        'bytes_per_s': iterations * size / elapsed,
+    }
+
+
+UDS_SERVICES = {
+    'testerPresent': lambda uds: uds.testerPresent(),
+    'setSession': lambda uds: uds.setSession(0x03),
+    'readDataByIdentifier': lambda uds: uds.readDataByIdentifier(0xF190),
+    'writeDataByIdentifier': lambda uds: uds.writeDataByIdentifier(0xF190, bytearray(17)),
+    'routineStart': lambda uds: uds.routineStart(0xAABB, bytearray(4)),
+    'requestSeed': lambda uds: uds.requestSeed(0x01),
+}
+
+
+def udsLatency(service: str, iterations: int = 200, fd: bool = False,
+               pending: int = 0, bitrate: int = None, dataBitrate: int = None):
+    uds, ecu, close = _udsPair(fd, bitrate, dataBitrate, pending)
+    call = UDS_SERVICES[service]
+
+    ecu.start()
+    try:
+        samples = []
+        for _ in range(iterations):
+            start = perf_counter()
+            ret, _ = call(uds)
+            samples.append(perf_counter() - start)
+
+            if not ret:
+                raise Exception("Negative response from %s" % service)
+    finally:
+        ecu.stop()
+        close()
+
+    return _latencyStats(samples)
+
+
+def downloadThroughput(size: int, fd: bool = False, blockLength: int = None,
+                       bitrate: int = None, dataBitrate: int = None):
+    if blockLength is None:
+        blockLength = 0xFFF if not fd else 0x4000
+
+    uds, ecu, close = _udsPair(fd, bitrate, dataBitrate, maxBlockLength=blockLength)
+    image = bytes(i & 0xFF for i in range(size))
+
+    ecu.start()
+    try:
+        ret, result = uds.download(0, image)
+        if not ret:
+            raise Exception("Download refused")
+    finally:
+        ecu.stop()
+        close()
+
+    return {
+        'elapsed_s': result.elapsed,
+        'bytes_per_s': result.throughput,
+        'blocks': result.blocks,
+    }
+
+
+def run(only: str = None, quick: bool = False,
+        bitrate: int = None, dataBitrate: int = None) -> dict:
+    duration = 0.2 if quick else 1.0
+    iterations = 50 if quick else 500
+    downloadSize = 64 * 1024 if quick else 1024 * 1024
+
+    cases = []
+    for fd in (False, True):
+        for size in ISOTP_SIZES:
+            cases.append(('isotp.throughput', {'fd': fd, 'size': size},
+                          lambda fd=fd, size=size: isotpThroughput(
+                              fd, size, duration, bitrate, dataBitrate)))
+
+    for service in UDS_SERVICES:
+        cases.append(('uds.latency', {'service': service},
+                      lambda service=service: udsLatency(
+                          service, iterations, False, 0, bitrate, dataBitrate)))
+
+    for pending in (1, 3):
+        cases.append(('uds.pending', {'service': 'routineStart', 'pending': pending},
+                      lambda pending=pending: udsLatency(
+                          'routineStart', iterations, False, pending,
+                          bitrate, dataBitrate)))
+
+    for fd in (False, True):
+        cases.append(('uds.download', {'fd': fd, 'size': downloadSize},
+                      lambda fd=fd: downloadThroughput(
+                          downloadSize, fd, None, bitrate, dataBitrate)))
+
+    results = []
+    for name, params, bench in cases:
+        if only and only not in name:
+            continue
+
+        results.append({'name': name, 'params': params, 'metrics': bench()})
+
+    return {
+        'timestamp': time(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'machine': platform.machine(),
+        'bitrate': bitrate,
+        'data_bitrate': dataBitrate,
+        'quick': quick,
+        'results': results,
+    }
@@ -0,0 +1,42 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import json
+import sys
+from . import run
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='pycan-bench',
+        description='Benchmark the pycan ISO-TP/UDS stack over a loopback transport.')
+    parser.add_argument('--only', help='run only benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='shorter runs, for CI smoke tests')
+    parser.add_argument('--bitrate', type=int, help='model a bus at this nominal bit rate')
+    parser.add_argument('--data-bitrate', type=int, help='CAN FD data phase bit rate')
+    parser.add_argument('-o', '--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args(argv)
+
+    report = run(args.only, args.quick, args.bitrate, args.data_bitrate)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
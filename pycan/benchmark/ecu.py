@@ -0,0 +1,87 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from ..pyisotp import ISOTP
+from threading import Thread
+
+
+class SimulatedECU(object):
+    def __init__(self,
+                 isotp: ISOTP,
+                 pending: int = 0,
+                 maxBlockLength: int = 0xFFF,
+                 didValue: bytes = b'PYCAN-BENCHMARK-0'):
+        self._isotp = isotp
+        self._thread = None
+        self._running = False
+
+        # Number of 0x78 responses sent before each final response
+        self.pending = pending
+        self.maxBlockLength = maxBlockLength
+        self.didValue = didValue
+        self.requests = 0
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while self._running:
+            try:
+                request = self._isotp.recv(0.1)
+            except Exception:
+                continue
+
+            self.requests += 1
+            sid = request[0]
+
+            for _ in range(self.pending):
+                self._isotp.send(bytearray([0x7F, sid, 0x78]))
+
+            self._isotp.send(self.handle(request))
+
+    def handle(self, request) -> bytearray:
+        sid = request[0]
+
+        # Read Data By Identifier
+        if 0x22 == sid:
+            return bytearray([0x62]) + request[1:3] + self.didValue
+
+        # Request Download, answer with our maxNumberOfBlockLength
+        if 0x34 == sid:
+            return bytearray([0x74, 0x40]) + self.maxBlockLength.to_bytes(4, 'big')
+
+        # Transfer Data
+        if 0x36 == sid:
+            return bytearray([0x76, request[1]])
+
+        # Routine Control
+        if 0x31 == sid:
+            return bytearray([0x71]) + request[1:4]
+
+        # Write Data By Identifier
+        if 0x2E == sid:
+            return bytearray([0x6E]) + request[1:3]
+
+        # Security Access, seed requests get a fixed seed
+        if 0x27 == sid and request[1] % 2:
+            return bytearray([0x67, request[1], 0x12, 0x34, 0x56, 0x78])
+
+        return bytearray([sid + 0x40]) + request[1:2]
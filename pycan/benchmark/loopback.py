@@ -0,0 +1,67 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from ..datatypes import CanMessage
+from ..dispatcher import ISOTPDispatcher
+from ..pyisotp import ISOTP
+from ..virtualbus import VirtualBus
+
+
+def loopbackPair(fd: bool = False,
+                 bitrate: int = None,
+                 dataBitrate: int = None,
+                 testerId: int = 0x710,
+                 ecuId: int = 0x718,
+                 **options):
+    # Without a bit rate frames are fed straight into the peer, which
+    # measures the stack alone. With one they cross a VirtualBus, each side
+    # with its own reader thread. Returns both ends and a close callback.
+    if bitrate:
+        bus = VirtualBus(bitrate, dataBitrate)
+        a = bus.attach()
+        b = bus.attach()
+        testerSide = ISOTPDispatcher(a.recv, a.send, a.sendMany, fd, **options)
+        ecuSide = ISOTPDispatcher(b.recv, b.send, b.sendMany, fd, **options)
+        tester = testerSide.connect(ecuId, testerId)
+        ecu = ecuSide.connect(testerId, ecuId)
+        testerSide.start()
+        ecuSide.start()
+
+        def close():
+            testerSide.stop()
+            ecuSide.stop()
+
+        return tester, ecu, close
+
+    peers = {}
+
+    def testerSend(id, extended, fd, data):
+        peers['ecu'].feed(CanMessage(None, id, extended, bytes(data), fd))
+        return len(data)
+
+    def testerSendMany(id, extended, fd, frames):
+        for data in frames:
+            peers['ecu'].feed(CanMessage(None, id, extended, bytes(data), fd))
+        return len(frames)
+
+    def ecuSend(id, extended, fd, data):
+        peers['tester'].feed(CanMessage(None, id, extended, bytes(data), fd))
+        return len(data)
+
+    tester = ISOTP(None, testerSend, rxid=ecuId, txid=testerId, fd=fd,
+                   sendMany=testerSendMany, **options)
+    ecu = ISOTP(None, ecuSend, rxid=testerId, txid=ecuId, fd=fd, **options)
+    peers['tester'] = tester
+    peers['ecu'] = ecu
+
+    return tester, ecu, lambda: None
@@ -11,34 +11,119 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from dataclasses import dataclass
 
 
-@dataclass
-class CanMessage:
+class CanMessage(object):
+    # Fields are plain slots, read them directly on hot paths. The accessor
+    # methods below are kept for existing callers.
+    __slots__ = ('time', 'arbitrationId', 'isExtended', 'payload', 'isFd')
+
     def __init__(self,
                  timestamp,
                  id: int,
                  extended: bool,
                  data: bytearray,
                  fd: bool = False):
-        self._timestamp = timestamp
-        self._id = id
-        self._extended = extended
-        self._data = data
-        self._fd = fd
+        self.time = timestamp
+        self.arbitrationId = id
+        self.isExtended = extended
+        self.payload = data
+        self.isFd = fd
+
+    def __repr__(self):
+        return 'CanMessage(%r, 0x%X, %r, %r, %r)' % (
+            self.time, self.arbitrationId, self.isExtended,
+            bytes(self.payload), self.isFd)
+
+    def __eq__(self, other):
+        if not isinstance(other, CanMessage):
+            return NotImplemented
+
+        return (self.time == other.time
+                and self.arbitrationId == other.arbitrationId
+                and self.isExtended == other.isExtended
+                and self.payload == other.payload
+                and self.isFd == other.isFd)
 
     def timestamp(self):
-        return self._timestamp
+        return self.time
 
     def id(self):
-        return self._id
+        return self.arbitrationId
 
     def extended(self):
-        return self._extended
+        return self.isExtended
 
     def data(self):
-        return self._data
+        return self.payload
 
     def fd(self):
-        return self._fd
+        return self.isFd
+
+
+class CanFrameRing(object):
+    # Fixed set of CanMessage records, each with its own buffer, reused in
+    # turn. A record returned by get() stays valid until the producer wraps
+    # around to it, so consume or copy it before then. One producer and one
+    # consumer, no locking.
+    def __init__(self, capacity: int = 1024, frameSize: int = 64):
+        self._frames = [CanMessage(None, 0, False, b'') for _ in range(capacity)]
+        self._views = [memoryview(bytearray(frameSize)) for _ in range(capacity)]
+        self._capacity = capacity
+        self._head = 0
+        self._tail = 0
+        self._count = 0
+
+        # Frames overwritten before they were read
+        self.dropped = 0
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def __len__(self):
+        return self._count
+
+    def claim(self) -> memoryview:
+        # Buffer of the next slot, fill it in place then commit()
+        return self._views[self._head]
+
+    def commit(self, timestamp, id: int, extended: bool, offset: int,
+               size: int, fd: bool = False) -> CanMessage:
+        head = self._head
+        msg = self._frames[head]
+        msg.time = timestamp
+        msg.arbitrationId = id
+        msg.isExtended = extended
+        msg.payload = self._views[head][offset: offset + size]
+        msg.isFd = fd
+
+        self._head = (head + 1) % self._capacity
+        if self._count == self._capacity:
+            # Full, the oldest frame is lost
+            self._tail = self._head
+            self.dropped += 1
+        else:
+            self._count += 1
+
+        return msg
+
+    def put(self, timestamp, id: int, extended: bool, data, fd: bool = False) -> CanMessage:
+        size = len(data)
+        self.claim()[:size] = data
+        return self.commit(timestamp, id, extended, 0, size, fd)
+
+    def get(self) -> CanMessage:
+        if 0 == self._count:
+            return None
+
+        msg = self._frames[self._tail]
+        self._tail = (self._tail + 1) % self._capacity
+        self._count -= 1
+
+        return msg
+
+    def clear(self):
+        self._head = 0
+        self._tail = 0
+        self._count = 0
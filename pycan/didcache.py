@@ -0,0 +1,99 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import OrderedDict
+from collections.abc import Callable
+from threading import Lock
+from time import monotonic
+
+
+class DIDCache(object):
+    # Values read by DID, keyed by (ECU, DID) where the ECU is the request
+    # id. Entries expire after their TTL (None keeps them until evicted or
+    # invalidated), the least recently used go first once maxSize is reached.
+    def __init__(self,
+                 maxSize: int = 256,
+                 ttl: float = None,
+                 ttls: dict = None,
+                 clock: Callable[[], float] = monotonic):
+        self._maxSize = maxSize
+        self._ttl = ttl
+        self._ttls = dict(ttls or {})
+        self._clock = clock
+        self._lock = Lock()
+        # (ecu, did) -> (value, expiry)
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def setTTL(self, did: int, ttl: float):
+        self._ttls[did] = ttl
+
+    def get(self, ecu: int, did: int) -> bytearray:
+        key = (ecu, did)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (None == entry[1] or entry[1] > self._clock()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return bytearray(entry[0])
+
+            if entry is not None:
+                del self._entries[key]
+
+            self.misses += 1
+            return None
+
+    def put(self, ecu: int, did: int, value):
+        ttl = self._ttls.get(did, self._ttl)
+        if 0 == ttl:
+            return
+
+        expiry = None if None == ttl else self._clock() + ttl
+
+        key = (ecu, did)
+        with self._lock:
+            self._entries[key] = (bytes(value), expiry)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self._maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, ecu: int, did: int):
+        with self._lock:
+            self._entries.pop((ecu, did), None)
+
+    def flush(self, ecu: int = None):
+        with self._lock:
+            if None == ecu:
+                self._entries.clear()
+                return
+
+            for key in [key for key in self._entries if key[0] == ecu]:
+                del self._entries[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hitRate': self.hits / total if total else 0,
+        }
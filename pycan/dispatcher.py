@@ -0,0 +1,149 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections.abc import Callable
+from .datatypes import CanMessage
+from .pyisotp import ISOTP
+from threading import Lock, Thread
+from time import monotonic
+
+
+class ISOTPDispatcher(object):
+    def __init__(self,
+                 recv: Callable[[int], CanMessage],
+                 send: Callable[[int, bool, bool, bytearray], int],
+                 sendMany: Callable[[int, bool, bool, list], int] = None,
+                 fd: bool = False,
+                 pollInterval: float = 0.05,
+                 **options):
+        self._recvFn = recv
+        self._sendFn = send
+        self._sendManyFn = sendMany
+        self._fd = fd
+        self._pollInterval = pollInterval
+        self._options = options
+
+        # Spinning for STmin holds the GIL, which starves the other
+        # connections' threads. Sleep only unless asked otherwise.
+        self._options.setdefault('spinThreshold', 0)
+
+        # (arbitration id, extended) -> connections listening on it
+        self._routes = {}
+        self._connections = []
+
+        self._lock = Lock()
+        self._thread = None
+        self._running = False
+
+    def connect(self,
+                rxid: int,
+                txid: int,
+                extended: bool = False,
+                fd: bool = None,
+                functionalId: int = None,
+                **options) -> ISOTP:
+        if None == fd:
+            fd = self._fd
+
+        kwargs = dict(self._options)
+        kwargs.update(options)
+
+        if self._sendManyFn:
+            kwargs['sendMany'] = self._sendMany
+
+        conn = ISOTP(None, self._send, rxid, txid, extended, fd, **kwargs)
+
+        self._route(rxid, extended, conn)
+
+        # Functionally addressed requests reach every ECU sharing the id
+        if functionalId is not None:
+            conn.open(functionalId, txid, extended)
+            self._route(functionalId, extended, conn)
+
+        self._connections = self._connections + [conn]
+
+        return conn
+
+    def listen(self, id: int, extended: bool, listener):
+        # Raw frames on this id go to listener.feed(), for traffic outside
+        # ISO-TP such as periodic data. disconnect() removes it.
+        self._route(id, extended, listener)
+
+    def disconnect(self, conn: ISOTP):
+        for key, conns in list(self._routes.items()):
+            if conn in conns:
+                conns = tuple(c for c in conns if c is not conn)
+                if conns:
+                    self._routes[key] = conns
+                else:
+                    del self._routes[key]
+
+        self._connections = [c for c in self._connections if c is not conn]
+
+    def feed(self, msg: CanMessage) -> bool:
+        conns = self._routes.get((msg.arbitrationId, msg.isExtended))
+        if conns is None:
+            return False
+
+        for conn in conns:
+            conn.feed(msg)
+
+        return True
+
+    def poll(self, now: float = None):
+        if None == now:
+            now = monotonic()
+
+        for conn in self._connections:
+            conn.poll(now)
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        # The recv callback is asked for any id and should block for a short
+        # while when the bus is idle
+        lastPoll = monotonic()
+        while self._running:
+            msg = self._recvFn(None)
+            if msg is not None:
+                self.feed(msg)
+
+            now = monotonic()
+            if now - lastPoll >= self._pollInterval:
+                lastPoll = now
+                self.poll(now)
+
+# private
+    def _route(self, id, extended, conn):
+        self._routes[(id, extended)] = self._routes.get((id, extended), ()) + (conn,)
+
+    def _send(self, id, extended, fd, data):
+        with self._lock:
+            return self._sendFn(id, extended, fd, data)
+
+    def _sendMany(self, id, extended, fd, frames):
+        with self._lock:
+            return self._sendManyFn(id, extended, fd, frames)
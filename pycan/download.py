@@ -0,0 +1,253 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import io
+import mmap
+import os
+import zlib
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+
+# Used when the 0x74 response carries no usable maxNumberOfBlockLength
+DEFAULT_BLOCK_LENGTH = 0x102
+
+# Read size for file objects that can be neither mapped nor buffered
+READ_CHUNK = 0x10000
+
+
+def parseMaxBlockLength(response) -> int:
+    # Positive 0x74 response without its SID: lengthFormatIdentifier, whose
+    # high nibble is the size of the maxNumberOfBlockLength that follows
+    if not response:
+        return None
+
+    n = response[0] >> 4
+    if 0 == n or len(response) < 1 + n:
+        return None
+
+    return int.from_bytes(bytes(response[1: 1 + n]), 'big')
+
+
+class DownloadSource(object):
+    # Image to download: a path or file (memory mapped), an in-memory or
+    # unmappable file object, any buffer, or an iterable of chunks together
+    # with its size. Blocks are handed out as memoryviews, slices of the
+    # image itself whenever possible.
+    def __init__(self, source, size: int = None):
+        self._file = None
+        self._map = None
+        self._view = None
+        self._chunks = None
+
+        if isinstance(source, (str, os.PathLike)):
+            source = self._file = open(source, 'rb')
+
+        try:
+            self._open(source, size)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def blocks(self, length: int):
+        if self._view is not None:
+            for offset in range(0, self.size, length):
+                yield self._view[offset: offset + length]
+            return
+
+        # Re-block the chunks, stop at the announced size
+        pending = bytearray()
+        remaining = self.size
+        for chunk in self._chunks:
+            pending += chunk
+
+            while len(pending) >= length and remaining:
+                block = bytes(pending[:min(length, remaining)])
+                del pending[:length]
+                remaining -= len(block)
+                yield memoryview(block)
+
+            if not remaining:
+                return
+
+        if len(pending) < remaining:
+            raise Exception("Source ended %d bytes short" % (remaining - len(pending)))
+
+        if remaining:
+            yield memoryview(bytes(pending[:remaining]))
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# private
+    def _open(self, source, size):
+        fileno = None
+        if hasattr(source, 'fileno'):
+            try:
+                fileno = source.fileno()
+            except (OSError, io.UnsupportedOperation):
+                # io.BytesIO and other in-memory files
+                pass
+
+        if fileno is not None:
+            # An empty file can't be mapped
+            if os.fstat(fileno).st_size:
+                self._map = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+            else:
+                self._view = memoryview(b'')
+        elif hasattr(source, 'getbuffer'):
+            self._view = source.getbuffer()
+        elif hasattr(source, 'read'):
+            if None == size:
+                self._view = memoryview(source.read())
+            else:
+                self._chunks = iter(partial(source.read, READ_CHUNK), b'')
+        else:
+            try:
+                self._view = memoryview(source).cast('B')
+            except TypeError:
+                # Image regions and similar iterables know their size
+                if None == size:
+                    size = getattr(source, 'size', None)
+                if None == size:
+                    raise Exception("Size is required for iterable sources")
+                self._chunks = iter(source)
+
+        if self._view is not None:
+            if None != size:
+                self._view = self._view[:size]
+            size = len(self._view)
+
+        self.size = size
+
+
+def zlibCompressor(level: int = 6) -> Callable[[bytes], bytes]:
+    # A partial of a builtin, so it also works in a process pool
+    return partial(zlib.compress, level=level)
+
+
+def _encode(segment, compress, encrypt):
+    if compress:
+        segment = compress(segment)
+
+    if encrypt:
+        segment = encrypt(segment)
+
+    return segment
+
+
+class DownloadEncoder(object):
+    # Compresses and/or encrypts the image in segments on a pool, ahead of
+    # the Transfer Data sequence. Segments are encoded independently and
+    # their output is sent back to back in maximal blocks, the
+    # dataFormatIdentifier passed to download() must tell the ECU what to
+    # expect. Both callables take and return bytes.
+    def __init__(self,
+                 compress: Callable[[bytes], bytes] = None,
+                 encrypt: Callable[[bytes], bytes] = None,
+                 segmentSize: int = 0x10000,
+                 workers: int = None,
+                 executor: Executor = None,
+                 prefetch: int = None):
+        self._compress = compress
+        self._encrypt = encrypt
+        self._segmentSize = segmentSize
+        self._workers = workers or os.cpu_count() or 1
+        self._executor = executor
+        # Segments submitted but not yet sent, bounds memory use
+        self._prefetch = prefetch or 2 * self._workers
+
+    def blocks(self, image: DownloadSource, length: int,
+               onSegment: Callable[[bytes], None] = None):
+        executor = self._executor
+        if executor is None:
+            executor = ThreadPoolExecutor(self._workers)
+
+        segments = image.blocks(self._segmentSize)
+        futures = deque()
+
+        def fill():
+            while len(futures) < self._prefetch:
+                segment = next(segments, None)
+                if segment is None:
+                    return
+
+                # Copied, the pool must not hold on to the mapped image
+                with segment:
+                    raw = bytes(segment)
+
+                futures.append((raw, executor.submit(
+                    _encode, raw, self._compress, self._encrypt)))
+
+        try:
+            fill()
+
+            pending = bytearray()
+            while futures:
+                raw, future = futures.popleft()
+                # Keep the workers busy while this segment is being sent
+                fill()
+
+                pending += future.result()
+                if onSegment:
+                    onSegment(raw)
+
+                while len(pending) >= length:
+                    block = bytes(pending[:length])
+                    del pending[:length]
+                    yield memoryview(block)
+
+            if pending:
+                yield memoryview(bytes(pending))
+        finally:
+            for _, future in futures:
+                future.cancel()
+
+            if executor is not self._executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DownloadResult(object):
+    def __init__(self, size: int):
+        self.size = size
+        self.sent = 0
+        # Image bytes handed to the encoder, equal to sent without one
+        self.processed = 0
+        self.blocks = 0
+        self.blockLength = 0
+        self.checksum = None
+        self.elapsed = 0
+        # Data of the last response, the NRC when a step was refused
+        self.response = None
+
+    @property
+    def throughput(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0
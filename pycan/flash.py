@@ -0,0 +1,179 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+from .download import DownloadEncoder
+from .image import Image, ImageRegion
+from .pyuds import UDS
+
+
+class FlashJob(object):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    # Full reprogramming sequence for one ECU on its own connection. image is
+    # a path, an Image or a list of ImageRegion / (address, data) pairs.
+    # key(seed, level) computes the security key, None skips security access.
+    def __init__(self,
+                 name: str,
+                 uds: UDS,
+                 image,
+                 bus='default',
+                 session: int = 0x02,
+                 securityLevel: int = 0x01,
+                 key: Callable[[bytes, int], bytes] = None,
+                 erase: bool = True,
+                 reset: int = UDS.ResetType.HARD_RESET,
+                 gap: int = 0,
+                 alignment: int = 1,
+                 fmt: int = 0,
+                 encoder: DownloadEncoder = None,
+                 eraseTimeout: int = 10):
+        self.name = name
+        self.uds = uds
+        self.image = image
+        self.bus = bus
+        self.session = session
+        self.securityLevel = securityLevel
+        self.key = key
+        self.erase = erase
+        self.reset = reset
+        self.gap = gap
+        self.alignment = alignment
+        self.fmt = fmt
+        self.encoder = encoder
+        self.eraseTimeout = eraseTimeout
+
+        self.state = FlashJob.PENDING
+        self.step = None
+        self.error = None
+        self.elapsed = 0
+        self.downloads = []
+
+    @property
+    def sent(self):
+        return sum(result.sent for result in self.downloads)
+
+
+class FlashOrchestrator(object):
+    # Runs one thread per ECU. maxPerBus caps the downloads in flight on
+    # each bus, an int for every bus or a dict by bus name; the other steps
+    # mostly wait on the ECU and are not limited.
+    def __init__(self,
+                 maxPerBus=2,
+                 onProgress: Callable[[FlashJob], None] = None):
+        self._maxPerBus = maxPerBus
+        self._onProgress = onProgress
+        self._lock = Lock()
+        self._buses = {}
+
+    def run(self, jobs) -> list:
+        jobs = list(jobs)
+        if not jobs:
+            return jobs
+
+        with ThreadPoolExecutor(len(jobs)) as executor:
+            for future in [executor.submit(self._flash, job) for job in jobs]:
+                future.result()
+
+        return jobs
+
+# private
+    def _limit(self, bus):
+        with self._lock:
+            semaphore = self._buses.get(bus)
+            if semaphore is None:
+                limit = self._maxPerBus
+                if isinstance(limit, dict):
+                    limit = limit.get(bus, 1)
+                semaphore = self._buses[bus] = BoundedSemaphore(limit)
+
+        return semaphore
+
+    def _flash(self, job):
+        job.state = FlashJob.RUNNING
+        start = perf_counter()
+
+        image = None
+        try:
+            uds = job.uds
+
+            job.step = 'setSession'
+            self._check(job, uds.setSession(job.session))
+
+            if job.key:
+                job.step = 'requestSeed'
+                seed = self._check(job, uds.requestSeed(job.securityLevel))
+
+                # An all zero seed means the ECU is already unlocked
+                if any(seed):
+                    job.step = 'sendKey'
+                    self._check(job, uds.sendKey(job.securityLevel + 1,
+                                                 job.key(bytes(seed), job.securityLevel)))
+
+            regions = job.image
+            if isinstance(regions, str):
+                regions = image = Image(regions)
+            if isinstance(regions, Image):
+                regions = regions.regions(job.gap, job.alignment)
+
+            for region in regions:
+                if isinstance(region, ImageRegion):
+                    address, size, source = region.address, region.size, region
+                else:
+                    address, source = region
+                    size = len(source)
+
+                if job.erase:
+                    job.step = 'eraseMemory'
+                    self._check(job, uds.eraseMemory(address, size, job.eraseTimeout))
+
+                job.step = 'download'
+                with self._limit(job.bus):
+                    ret, result = uds.download(address, source, size, job.fmt,
+                                               onProgress=lambda _: self._progress(job),
+                                               encoder=job.encoder)
+                job.downloads.append(result)
+                self._check(job, (ret, result.response))
+
+            if None != job.reset:
+                job.step = 'reset'
+                self._check(job, uds.reset(job.reset))
+
+            job.step = None
+            job.state = FlashJob.DONE
+        except Exception as e:
+            job.error = e
+            job.state = FlashJob.FAILED
+        finally:
+            if image is not None:
+                image.close()
+
+            job.elapsed = perf_counter() - start
+            self._progress(job)
+
+    def _check(self, job, response):
+        ret, data = response
+        if not ret:
+            raise Exception("%s failed at %s: %s" % (job.name, job.step, bytes(data).hex()))
+
+        return data
+
+    def _progress(self, job):
+        if self._onProgress:
+            self._onProgress(job)
@@ -0,0 +1,314 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mmap
+import os
+from binascii import unhexlify
+
+HEX_EXTENSIONS = ('.hex', '.ihex', '.ihx')
+SREC_EXTENSIONS = ('.s19', '.s28', '.s37', '.srec', '.mot', '.sx')
+
+# Decoded data is handed out in pieces of about this size
+CHUNK_SIZE = 0x10000
+
+# S-record types carrying data, with their address size
+SREC_DATA = {1: 2, 2: 3, 3: 4}
+# S-record types carrying the start address
+SREC_START = {7: 4, 8: 3, 9: 2}
+
+
+class ImageSegment(object):
+    # Contiguous data, described by runs of records in the file and only
+    # decoded when read
+    def __init__(self, image, address: int, size: int, runs):
+        self._image = image
+        self.address = address
+        self.size = size
+        # (address, size, first line, end of the last line)
+        self._runs = runs
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    def chunks(self, start: int = None, stop: int = None):
+        start = self.address if None == start else max(start, self.address)
+        stop = self.end if None == stop else min(stop, self.end)
+
+        for address, size, first, last in self._runs:
+            if address + size <= start or address >= stop:
+                continue
+
+            offset = address
+            for data in self._image._decode(first, last, address):
+                end = offset + len(data)
+                if end > start and offset < stop:
+                    yield data[max(0, start - offset): min(len(data), stop - offset)]
+                offset = end
+
+    def read(self) -> bytes:
+        return b''.join(self.chunks())
+
+
+class ImageRegion(object):
+    # Address range to erase and download in one go, the gaps between and
+    # around its segments are filled
+    def __init__(self, address: int, size: int, segments, fill: int = 0xFF):
+        self.address = address
+        self.size = size
+        self.segments = segments
+        self.fill = fill
+
+    @property
+    def end(self):
+        return self.address + self.size
+
+    def __iter__(self):
+        return self.chunks()
+
+    def chunks(self):
+        offset = self.address
+        for segment in self.segments:
+            yield from self._fill(segment.address - offset)
+
+            for data in segment.chunks(self.address, self.end):
+                yield data
+
+            offset = segment.end
+
+        yield from self._fill(self.end - offset)
+
+    def read(self) -> bytes:
+        return b''.join(self.chunks())
+
+# private
+    def _fill(self, size):
+        while size > 0:
+            n = min(size, CHUNK_SIZE)
+            yield bytes([self.fill]) * n
+            size -= n
+
+
+class Image(object):
+    # Intel HEX, Motorola S-record or raw binary image. Opening only maps the
+    # file, records are indexed on first use and decoded when read.
+    def __init__(self, path: str, format: str = None, address: int = 0):
+        if None == format:
+            extension = os.path.splitext(path)[1].lower()
+            if extension in HEX_EXTENSIONS:
+                format = 'ihex'
+            elif extension in SREC_EXTENSIONS:
+                format = 'srec'
+            else:
+                format = 'bin'
+
+        if format not in ('ihex', 'srec', 'bin'):
+            raise Exception("Unknown image format %s" % format)
+
+        self.format = format
+        self._address = address
+        self._file = open(path, 'rb')
+        self._map = None
+        if os.fstat(self._file.fileno()).st_size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self._segments = None
+        self._start = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def segments(self) -> list:
+        if self._segments is None:
+            self._index()
+
+        return self._segments
+
+    @property
+    def start(self) -> int:
+        # Entry point from the start address record, if any
+        if self._segments is None:
+            self._index()
+
+        return self._start
+
+    @property
+    def size(self) -> int:
+        return sum(segment.size for segment in self.segments)
+
+    def regions(self, gap: int = 0, alignment: int = 1, fill: int = 0xFF) -> list:
+        # Segments closer than gap bytes share a region, regions are widened
+        # to the alignment (e.g. the flash sector size) and merged when they
+        # meet
+        regions = []
+        for segment in self.segments:
+            start = segment.address - segment.address % alignment
+            end = -(-segment.end // alignment) * alignment
+
+            if regions and start <= regions[-1][1] + gap:
+                regions[-1][1] = max(regions[-1][1], end)
+                regions[-1][2].append(segment)
+            else:
+                regions.append([start, end, [segment]])
+
+        return [ImageRegion(start, end - start, segments, fill)
+                for start, end, segments in regions]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.close()
+
+# private
+    def _index(self):
+        runs = []
+        if self._map is not None:
+            if 'bin' == self.format:
+                runs = [[self._address, len(self._map), 0, len(self._map)]]
+            else:
+                runs = self._scan()
+
+        # Adjacent runs form a segment
+        runs.sort(key=lambda run: run[0])
+        segments = []
+        for run in runs:
+            if segments and run[0] < segments[-1][0] + segments[-1][1]:
+                raise Exception("Overlapping data at 0x%X" % run[0])
+
+            if segments and run[0] == segments[-1][0] + segments[-1][1]:
+                segments[-1][1] += run[1]
+                segments[-1][2].append(tuple(run))
+            else:
+                segments.append([run[0], run[1], [tuple(run)]])
+
+        self._segments = [ImageSegment(self, address, size, runs)
+                          for address, size, runs in segments]
+
+    def _scan(self):
+        # Only the record headers are parsed, consecutive data records with
+        # consecutive addresses become one run of lines
+        data = self._map
+        length = len(data)
+        hex = 'ihex' == self.format
+
+        runs = []
+        run = None
+        base = 0
+        pos = 0
+        while pos < length:
+            eol = data.find(b'\n', pos)
+            if eol < 0:
+                eol = length
+            end = eol + 1
+
+            if hex and 0x3A == data[pos]:
+                header = int(data[pos + 1: pos + 9], 16)
+                count = header >> 24
+                type = header & 0xFF
+
+                if 0 == type:
+                    address = base + ((header >> 8) & 0xFFFF)
+                elif 1 == type:
+                    break
+                elif 2 == type:
+                    base = int(data[pos + 9: pos + 13], 16) << 4
+                    address = None
+                elif 4 == type:
+                    base = int(data[pos + 9: pos + 13], 16) << 16
+                    address = None
+                else:
+                    if type in (3, 5):
+                        self._start = int(data[pos + 9: pos + 17], 16)
+                    address = None
+
+            elif not hex and 0x53 == data[pos]:
+                type = data[pos + 1] - 0x30
+                count = int(data[pos + 2: pos + 4], 16)
+
+                if type in SREC_DATA:
+                    n = SREC_DATA[type]
+                    address = int(data[pos + 4: pos + 4 + 2 * n], 16)
+                    count -= n + 1
+                else:
+                    if type in SREC_START:
+                        n = SREC_START[type]
+                        self._start = int(data[pos + 4: pos + 4 + 2 * n], 16)
+                    address = None
+            else:
+                address = None
+
+            if None != address:
+                if run and address == run[0] + run[1]:
+                    run[1] += count
+                    run[3] = end
+                else:
+                    run = [address, count, pos, end]
+                    runs.append(run)
+
+            pos = end
+
+        return runs
+
+    def _decode(self, first, last, address):
+        if 'bin' == self.format:
+            view = memoryview(self._map)
+            for offset in range(first, last, CHUNK_SIZE):
+                yield bytes(view[offset: min(last, offset + CHUNK_SIZE)])
+            view.release()
+            return
+
+        data = self._map
+        hex = 'ihex' == self.format
+        pieces = []
+        pending = 0
+        pos = first
+        while pos < last:
+            eol = data.find(b'\n', pos)
+            if eol < 0:
+                eol = len(data)
+            line = data[pos: eol].rstrip()
+            pos = eol + 1
+
+            if hex:
+                # Skip the address records between data records
+                if b'00' != line[7:9]:
+                    continue
+                raw = unhexlify(line[1:])
+                if sum(raw) & 0xFF:
+                    raise Exception("Bad checksum at 0x%X" % (address + pending))
+                chunk = raw[4:-1]
+            else:
+                n = SREC_DATA.get(line[1] - 0x30) if len(line) > 1 else None
+                if not n:
+                    continue
+                raw = unhexlify(line[2:])
+                if 0xFF != sum(raw) & 0xFF:
+                    raise Exception("Bad checksum at 0x%X" % (address + pending))
+                chunk = raw[1 + n: -1]
+
+            pieces.append(chunk)
+            pending += len(chunk)
+            if pending >= CHUNK_SIZE:
+                yield b''.join(pieces)
+                address += pending
+                pieces = []
+                pending = 0
+
+        if pieces:
+            yield b''.join(pieces)
@@ -0,0 +1,283 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+from bisect import bisect_left
+from collections.abc import Callable
+from threading import Lock
+from time import perf_counter
+
+# Upper bounds in seconds, an implicit +Inf bucket follows
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STMIN_BUCKETS = (0.0001, 0.0002, 0.0005, 0.001, 0.002, 0.005, 0.01,
+                 0.02, 0.05, 0.127)
+
+COUNTERS = ('framesTx', 'framesRx', 'bytesTx', 'bytesRx', 'flowControlWaits',
+            'sequenceErrors', 'timeouts', 'overflows', 'requests', 'pending',
+            'responseTimeouts')
+
+PROMETHEUS_NAMES = {
+    'framesTx': 'frames_tx_total',
+    'framesRx': 'frames_rx_total',
+    'bytesTx': 'bytes_tx_total',
+    'bytesRx': 'bytes_rx_total',
+    'flowControlWaits': 'flow_control_waits_total',
+    'sequenceErrors': 'sequence_errors_total',
+    'timeouts': 'timeouts_total',
+    'overflows': 'overflows_total',
+    'requests': 'requests_total',
+    'pending': 'response_pending_total',
+    'responseTimeouts': 'response_timeouts_total',
+    'firstFrame': 'first_frame_seconds',
+    'response': 'response_seconds',
+    'flowControlWait': 'flow_control_wait_seconds',
+    'separationTimeRequested': 'stmin_requested_seconds',
+    'separationTimeAchieved': 'stmin_achieved_seconds',
+}
+
+
+class Observer(object):
+    # Hooks called by ISOTP and UDS when an observer is attached. conn is the
+    # (txid, rxid) pair of the connection. Subclass and override what you
+    # need, without an observer none of these are called.
+    def frameSent(self, conn, frames: int, size: int):
+        pass
+
+    def frameReceived(self, conn, data):
+        pass
+
+    def flowControl(self, conn, flag: int, waited: float):
+        pass
+
+    def separationTime(self, conn, requested: float, achieved: float):
+        pass
+
+    def sequenceError(self, conn):
+        pass
+
+    def rxTimeout(self, conn):
+        pass
+
+    def overflow(self, conn):
+        pass
+
+    def request(self, conn, sid: int):
+        pass
+
+    def pending(self, conn, sid: int):
+        pass
+
+    def response(self, conn, sid: int, nrc: int = None):
+        pass
+
+    def responseTimeout(self, conn, sid: int):
+        pass
+
+
+class Histogram(object):
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict:
+        return {
+            'bounds': list(self.bounds),
+            'counts': list(self.counts),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+
+class ConnectionMetrics(object):
+    def __init__(self):
+        for name in COUNTERS:
+            setattr(self, name, 0)
+
+        self.negativeResponses = {}
+
+        self.firstFrame = Histogram()
+        self.response = Histogram()
+        self.flowControlWait = Histogram()
+        self.separationTimeRequested = Histogram(STMIN_BUCKETS)
+        self.separationTimeAchieved = Histogram(STMIN_BUCKETS)
+
+        # Request in flight: [sid, start, first frame seen]
+        self.inflight = None
+
+    def histograms(self):
+        return (('firstFrame', self.firstFrame),
+                ('response', self.response),
+                ('flowControlWait', self.flowControlWait),
+                ('separationTimeRequested', self.separationTimeRequested),
+                ('separationTimeAchieved', self.separationTimeAchieved))
+
+    def snapshot(self) -> dict:
+        ret = {name: getattr(self, name) for name in COUNTERS}
+        ret['negativeResponses'] = dict(self.negativeResponses)
+
+        for name, histogram in self.histograms():
+            ret[name] = histogram.snapshot()
+
+        return ret
+
+
+class Metrics(Observer):
+    def __init__(self, clock: Callable[[], float] = perf_counter):
+        self._clock = clock
+        self._lock = Lock()
+        self._connections = {}
+
+    def connection(self, conn) -> ConnectionMetrics:
+        metrics = self._connections.get(conn)
+        if metrics is None:
+            with self._lock:
+                metrics = self._connections.setdefault(conn, ConnectionMetrics())
+
+        return metrics
+
+    def frameSent(self, conn, frames, size):
+        metrics = self.connection(conn)
+        metrics.framesTx += frames
+        metrics.bytesTx += size
+
+    def frameReceived(self, conn, data):
+        metrics = self.connection(conn)
+        metrics.framesRx += 1
+        metrics.bytesRx += len(data)
+
+        # First frame of the response, flow control doesn't count
+        inflight = metrics.inflight
+        if inflight and not inflight[2] and data and 3 != data[0] >> 4:
+            inflight[2] = True
+            metrics.firstFrame.observe(self._clock() - inflight[1])
+
+    def flowControl(self, conn, flag, waited):
+        metrics = self.connection(conn)
+        metrics.flowControlWait.observe(waited)
+
+        if 1 == flag:
+            metrics.flowControlWaits += 1
+
+    def separationTime(self, conn, requested, achieved):
+        metrics = self.connection(conn)
+        metrics.separationTimeRequested.observe(requested)
+        metrics.separationTimeAchieved.observe(achieved)
+
+    def sequenceError(self, conn):
+        self.connection(conn).sequenceErrors += 1
+
+    def rxTimeout(self, conn):
+        self.connection(conn).timeouts += 1
+
+    def overflow(self, conn):
+        self.connection(conn).overflows += 1
+
+    def request(self, conn, sid):
+        metrics = self.connection(conn)
+        metrics.requests += 1
+        metrics.inflight = [sid, self._clock(), False]
+
+    def pending(self, conn, sid):
+        self.connection(conn).pending += 1
+
+    def response(self, conn, sid, nrc=None):
+        metrics = self.connection(conn)
+
+        inflight = metrics.inflight
+        if inflight:
+            metrics.response.observe(self._clock() - inflight[1])
+            metrics.inflight = None
+
+        if None != nrc:
+            metrics.negativeResponses[nrc] = metrics.negativeResponses.get(nrc, 0) + 1
+
+    def responseTimeout(self, conn, sid):
+        metrics = self.connection(conn)
+        metrics.responseTimeouts += 1
+        metrics.inflight = None
+
+    def reset(self):
+        with self._lock:
+            self._connections = {}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            connections = list(self._connections.items())
+
+        return {self._label(conn): metrics.snapshot()
+                for conn, metrics in connections}
+
+    def prometheus(self, prefix: str = 'pycan') -> str:
+        with self._lock:
+            connections = sorted(self._connections.items(), key=lambda x: str(x[0]))
+
+        lines = []
+        for name in COUNTERS:
+            metric = '%s_%s' % (prefix, PROMETHEUS_NAMES[name])
+            lines.append('# TYPE %s counter' % metric)
+            for conn, metrics in connections:
+                lines.append('%s{%s} %d' % (metric, self._labels(conn),
+                                             getattr(metrics, name)))
+
+        metric = '%s_negative_responses_total' % prefix
+        lines.append('# TYPE %s counter' % metric)
+        for conn, metrics in connections:
+            for nrc, count in sorted(metrics.negativeResponses.items()):
+                lines.append('%s{%s,nrc="0x%02X"} %d' % (
+                    metric, self._labels(conn), nrc, count))
+
+        for name, _ in ConnectionMetrics().histograms():
+            metric = '%s_%s' % (prefix, PROMETHEUS_NAMES[name])
+            lines.append('# TYPE %s histogram' % metric)
+            for conn, metrics in connections:
+                histogram = dict(metrics.histograms())[name]
+                labels = self._labels(conn)
+
+                cumulative = 0
+                for bound, count in zip(histogram.bounds, histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{%s,le="%g"} %d' % (
+                        metric, labels, bound, cumulative))
+
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    metric, labels, histogram.count))
+                lines.append('%s_sum{%s} %.9g' % (metric, labels, histogram.sum))
+                lines.append('%s_count{%s} %d' % (metric, labels, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self, path: str, prefix: str = 'pycan'):
+        # Written aside and renamed so a textfile collector never sees a
+        # partial file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus(prefix))
+
+        os.replace(tmp, path)
+
+# private
+    def _label(self, conn):
+        txid, rxid = conn
+        return '%X/%X' % (txid, rxid if None != rxid else 0)
+
+    def _labels(self, conn):
+        txid, rxid = conn
+        return 'txid="0x%X",rxid="0x%X"' % (txid, rxid if None != rxid else 0)
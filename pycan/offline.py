@@ -0,0 +1,192 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+
+
+class OfflinePDU(object):
+    def __init__(self, timestamp, id: int, extended: bool, data: bytes, frame: int):
+        self.timestamp = timestamp
+        self.id = id
+        self.extended = extended
+        self.data = data
+        # Index of the frame completing the PDU
+        self.frame = frame
+
+
+class ReassemblyResult(object):
+    def __init__(self, pdus, sequenceErrors, timeouts, incomplete):
+        self.pdus = pdus
+        # Frame indexes of CFs with an unexpected sequence number
+        self.sequenceErrors = sequenceErrors
+        # Frame indexes of CFs arriving after N_Cr expired
+        self.timeouts = timeouts
+        # (first frame index, id, extended, announced size, received size)
+        self.incomplete = incomplete
+
+
+def reassemble(ids, dlcs, payloads,
+               extended=None,
+               timestamps=None,
+               nCr: float = None) -> ReassemblyResult:
+    ids = np.asarray(ids, dtype=np.int64)
+    dlcs = np.asarray(dlcs, dtype=np.int64)
+    payloads = np.asarray(payloads, dtype=np.uint8)
+    count = len(ids)
+
+    if extended is None:
+        extended = np.zeros(count, dtype=bool)
+    extended = np.asarray(extended, dtype=bool)
+
+    if timestamps is not None:
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+
+    width = payloads.shape[1]
+    if width < 8:
+        payloads = np.pad(payloads, ((0, 0), (0, 8 - width)))
+        width = 8
+
+    frameType = payloads[:, 0] >> 4
+    low = (payloads[:, 0] & 0xF).astype(np.int64)
+
+    # Single frames, FD SF_DL escape when the frame is longer than 8 bytes
+    sfEscape = (0 == low) & (dlcs > 8)
+    sfSize = np.where(sfEscape, payloads[:, 1], low)
+    sfOffset = np.where(sfEscape, 2, 1)
+    isSF = ((0 == frameType) & (dlcs >= 2)
+            & (sfSize > 0) & (dlcs - sfOffset >= sfSize))
+
+    # First frames, 12 bit length or escape sequence with a 32 bit length
+    ffSize = (low << 8) | payloads[:, 1]
+    ffEscape = 0 == ffSize
+    ffSize32 = ((payloads[:, 2].astype(np.int64) << 24)
+                | (payloads[:, 3].astype(np.int64) << 16)
+                | (payloads[:, 4].astype(np.int64) << 8)
+                | payloads[:, 5])
+    ffSize = np.where(ffEscape, ffSize32, ffSize)
+    ffOffset = np.where(ffEscape, 6, 2)
+    isFF = ((1 == frameType) & (dlcs >= 2)
+            & ~(ffEscape & ((dlcs < 8) | (ffSize <= 0xFFF))))
+
+    isCF = (2 == frameType) & (dlcs >= 2)
+
+    # Only frames the live stack acts on take part, grouped per address in
+    # arrival order
+    key = ids | (extended.astype(np.int64) << 32)
+    keep = np.flatnonzero(isSF | isFF | isCF)
+    order = keep[np.argsort(key[keep], kind='stable')]
+    n = len(order)
+
+    if 0 == n:
+        return ReassemblyResult([], np.empty(0, np.int64), np.empty(0, np.int64), [])
+
+    k = key[order]
+    sf = isSF[order]
+    ff = isFF[order]
+    cf = isCF[order]
+
+    # A segment starts on every SF, FF or address change
+    newKey = np.empty(n, dtype=bool)
+    newKey[0] = True
+    newKey[1:] = k[1:] != k[:-1]
+    start = newKey | sf | ff
+    segment = np.cumsum(start) - 1
+    segStart = np.flatnonzero(start)
+    position = np.arange(n) - segStart[segment]
+    headFF = ff[segStart]
+
+    # CF sequence numbers count up from 1 after the FF
+    inTransfer = cf & headFF[segment]
+    seqError = inTransfer & (low[order] != (position & 0xF))
+
+    timeout = np.zeros(n, dtype=bool)
+    if nCr is not None and timestamps is not None:
+        t = timestamps[order]
+        gap = np.zeros(n)
+        gap[1:] = t[1:] - t[:-1]
+        timeout = inTransfer & (gap > nCr)
+
+    # Bytes each frame contributes before truncation to the announced size
+    offset = np.where(ff, ffOffset[order], np.where(sf, sfOffset[order], 1))
+    avail = np.where(sf, sfSize[order], dlcs[order] - offset)
+    size = np.where(headFF, ffSize[order][segStart], sfSize[order][segStart])[segment]
+
+    # Everything from the first broken CF of a segment on is ignored
+    broken = seqError | timeout
+    brokenCs = np.cumsum(broken)
+    brokenBefore = brokenCs - (brokenCs[segStart] - broken[segStart])[segment]
+    valid = (~cf | inTransfer) & (0 == brokenBefore)
+
+    # Only the CF aborting the transfer is reported, N_Cr is checked first
+    firstBreak = broken & (1 == brokenBefore)
+    timeout &= firstBreak
+    seqError &= firstBreak & ~timeout
+
+    avail = np.where(valid, avail, 0)
+    availCs = np.cumsum(avail)
+    before = availCs - avail - (availCs[segStart] - avail[segStart])[segment]
+    take = np.clip(size - before, 0, avail)
+
+    # CFs after the PDU completed are not part of any transfer
+    done = before >= size
+    seqError &= ~done
+    timeout &= ~done
+
+    received = before + take
+    complete = (take > 0) & (received == size)
+    finals = np.flatnonzero(complete)
+
+    # One gather over the payload matrix produces all PDUs back to back
+    columns = np.arange(width)
+    mask = ((columns >= offset[:, None])
+            & (columns < (offset + take)[:, None]))
+    completeSeg = np.zeros(len(segStart), dtype=bool)
+    completeSeg[segment[finals]] = True
+    used = completeSeg[segment] & (take > 0)
+    flat = payloads[order[used]][mask[used]].tobytes()
+
+    lengths = size[finals]
+    bounds = np.concatenate(([0], np.cumsum(lengths)))
+    firstFrames = order[segStart[segment[finals]]]
+
+    pdus = []
+    for i, f in enumerate(finals):
+        frame = order[f]
+        first = firstFrames[i]
+        pdus.append(OfflinePDU(
+            None if timestamps is None else float(timestamps[first]),
+            int(ids[frame]),
+            bool(extended[frame]),
+            flat[bounds[i]: bounds[i + 1]],
+            int(frame)))
+
+    # Deliver in the order the live stack would, by completing frame
+    pdus.sort(key=lambda pdu: pdu.frame)
+
+    incomplete = []
+    openSegs = np.flatnonzero(headFF & ~completeSeg)
+    if len(openSegs):
+        receivedPerSeg = np.zeros(len(segStart), dtype=np.int64)
+        np.add.at(receivedPerSeg, segment, take)
+        for s in openSegs:
+            first = order[segStart[s]]
+            incomplete.append((int(first),
+                               int(ids[first]),
+                               bool(extended[first]),
+                               int(ffSize[first]),
+                               int(receivedPerSeg[s])))
+
+    return ReassemblyResult(pdus,
+                            np.sort(order[seqError]),
+                            np.sort(order[timeout]),
+                            incomplete)
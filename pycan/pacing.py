@@ -0,0 +1,98 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections.abc import Callable
+from time import perf_counter, sleep
+
+
+def decodeSTmin(separationTime: int) -> float:
+    # 0x00 - 0x7F: 0 - 127 ms
+    if separationTime <= 0x7F:
+        return separationTime / 1000
+
+    # 0xF1 - 0xF9: 100 - 900 us
+    if separationTime >= 0xF1 and separationTime <= 0xF9:
+        return (separationTime - 0xF0) / 10000
+
+    # Reserved values shall be handled as the maximum STmin
+    return 0x7F / 1000
+
+
+class STminPacer(object):
+    def __init__(self,
+                 spinThreshold: float = 0.002,
+                 tolerance: float = 0.0002,
+                 onMiss: Callable[[float], None] = None):
+        self._spinThreshold = spinThreshold
+        self._tolerance = tolerance
+        self._onMiss = onMiss
+        self._interval = 0
+        self._deadline = 0
+
+        self.requested = 0
+        self.frames = 0
+        # First and last frame since start(), for the achieved STmin
+        self._first = None
+        self._last = None
+        self._count = 0
+        self.missed = 0
+        self.maxLateness = 0
+
+    def start(self, separationTime: int):
+        self._interval = decodeSTmin(separationTime)
+        self.requested = self._interval
+
+        # The first CF after a FC is not subject to STmin
+        self._deadline = perf_counter()
+        self._first = None
+        self._count = 0
+
+    def wait(self):
+        deadline = self._deadline
+        now = perf_counter()
+
+        if now < deadline:
+            # Coarse sleep, then spin for the last stretch the OS scheduler
+            # can't resolve
+            remaining = deadline - now - self._spinThreshold
+            if remaining > 0:
+                sleep(remaining)
+
+            now = perf_counter()
+            while now < deadline:
+                now = perf_counter()
+
+        elif self._interval and now - deadline > self._tolerance:
+            # Late, report it and restart the schedule from now rather than
+            # bursting frames to catch up
+            lateness = now - deadline
+            self.missed += 1
+            self.maxLateness = max(self.maxLateness, lateness)
+
+            if self._onMiss:
+                self._onMiss(lateness)
+
+        self.frames += 1
+        self._deadline = now + self._interval
+
+        if None == self._first:
+            self._first = now
+        self._last = now
+        self._count += 1
+
+    def achieved(self) -> float:
+        # Mean interval between the frames paced since start()
+        if self._count < 2:
+            return None
+
+        return (self._last - self._first) / (self._count - 1)
@@ -0,0 +1,141 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import deque
+from collections.abc import Callable
+from .datatypes import CanMessage
+from threading import Condition
+from time import monotonic
+
+# Periodic DIDs are the 0xF2xx range, requested by their low byte
+PERIODIC_DID_BASE = 0xF200
+
+
+class PeriodicSample(object):
+    __slots__ = ('time', 'did', 'data')
+
+    def __init__(self, time, did: int, data: bytes):
+        self.time = time
+        self.did = did
+        self.data = data
+
+    def __repr__(self):
+        return 'PeriodicSample(%r, 0x%X, %r)' % (self.time, self.did, self.data)
+
+
+class PeriodicSubscription(object):
+    # Receives the periodic frames (one frame per DID, the periodic id byte
+    # then the data, no ISO-TP header) through feed(), and hands samples to
+    # onSample and/or a bounded buffer read with get() or by iterating. When
+    # the buffer is full the oldest samples are dropped.
+    def __init__(self,
+                 uds,
+                 ids: list,
+                 rate: int,
+                 maxBuffered: int = 1024,
+                 onSample: Callable[[PeriodicSample], None] = None,
+                 lengths: dict = None,
+                 dispatcher=None,
+                 periodicId: int = None,
+                 extended: bool = False):
+        if dispatcher is not None and periodicId is None:
+            raise Exception("periodicId is required with a dispatcher")
+
+        self._uds = uds
+        self.ids = [PERIODIC_DID_BASE | (id & 0xFF) for id in ids]
+        self.rate = rate
+        self._onSample = onSample
+        # Record lengths, so padding can be cut off
+        self._lengths = lengths or {}
+        self._dispatcher = dispatcher
+        self._periodicId = periodicId
+        self._extended = extended
+
+        self._samples = deque(maxlen=maxBuffered)
+        self._condition = Condition()
+        self.active = True
+
+        self.received = 0
+        self.dropped = 0
+
+        if dispatcher is not None:
+            dispatcher.listen(periodicId, extended, self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __iter__(self):
+        while 1:
+            sample = self.get()
+            if sample is None:
+                return
+
+            yield sample
+
+    def feed(self, msg: CanMessage) -> bool:
+        data = msg.payload
+        if not self.active or not data:
+            return False
+
+        did = PERIODIC_DID_BASE | data[0]
+        if did not in self.ids:
+            return False
+
+        length = self._lengths.get(did)
+        value = bytes(data[1:] if None == length else data[1: 1 + length])
+        sample = PeriodicSample(msg.time if None != msg.time else monotonic(),
+                                did, value)
+
+        self.received += 1
+        if self._onSample:
+            self._onSample(sample)
+
+        with self._condition:
+            if len(self._samples) == self._samples.maxlen:
+                self.dropped += 1
+            self._samples.append(sample)
+            self._condition.notify()
+
+        return True
+
+    def get(self, timeout: float = None) -> PeriodicSample:
+        # Blocks until a sample arrives, None on timeout or once stopped and
+        # drained
+        with self._condition:
+            if not self._samples and self.active:
+                self._condition.wait(timeout)
+
+            if self._samples:
+                return self._samples.popleft()
+
+            return None
+
+    def stop(self, timeout: int = 2):
+        if not self.active:
+            return True, []
+
+        # Stop transmission first so nothing is left in flight for us
+        ret, data = self._uds.readDataByPeriodicIdentifier(
+            self._uds.PeriodicRate.STOP, self.ids, timeout)
+
+        if self._dispatcher is not None:
+            self._dispatcher.disconnect(self)
+
+        with self._condition:
+            self.active = False
+            self._condition.notify_all()
+
+        return ret, data
@@ -14,336 +14,781 @@
 
 from collections.abc import Callable
 from .datatypes import CanMessage
-from time import time, sleep
+from queue import Queue, Empty
+from .metrics import Observer
+from .pacing import STminPacer
+from time import monotonic
+
+
+# STmin raw values ordered by the separation time they request
+STMIN_LADDER = [0x00] + list(range(0xF1, 0xFA)) + list(range(0x01, 0x80))
+
+
+class AdaptiveFlowControl(object):
+    def __init__(self,
+                 maxBlockSize: int = 0,
+                 minSeparationTime: int = 0x00,
+                 maxSeparationTime: int = 0x7F,
+                 highWater: int = 4,
+                 maxWait: int = 10,
+                 waitInterval: float = 0.5,
+                 maxSize: int = 0xFFFFFFFF,
+                 recoverAfter: int = 4):
+        self.maxBlockSize = maxBlockSize
+        self.minSeparationTime = minSeparationTime
+        self.maxSeparationTime = maxSeparationTime
+        self.highWater = highWater
+        self.maxWait = maxWait
+        self.waitInterval = waitInterval
+        self.maxSize = maxSize
+        self.recoverAfter = recoverAfter
+
+    def status(self, session, size=None):
+        # Overflow
+        if size is not None and size > self.maxSize:
+            return 2
+
+        # Wait until the application drains the PDU queue
+        if session.pdus.qsize() >= self.highWater:
+            return 1
+
+        return 0
+
+    def onDrop(self, session):
+        session.cleanPdus = 0
+
+        idx = STMIN_LADDER.index(session.separationTime)
+        idx = min(idx * 2 + 1, STMIN_LADDER.index(self.maxSeparationTime))
+        session.separationTime = STMIN_LADDER[idx]
+
+        if 0 == session.blockSize:
+            session.blockSize = 16
+        else:
+            session.blockSize = max(1, session.blockSize // 2)
+
+    def onComplete(self, session):
+        session.cleanPdus += 1
+        if session.cleanPdus < self.recoverAfter:
+            return
+
+        session.cleanPdus = 0
+
+        idx = STMIN_LADDER.index(session.separationTime)
+        idx = max(idx - 1, STMIN_LADDER.index(self.minSeparationTime))
+        session.separationTime = STMIN_LADDER[idx]
+
+        if 0 != session.blockSize:
+            blockSize = session.blockSize * 2
+            if 0 != self.maxBlockSize:
+                blockSize = min(blockSize, self.maxBlockSize)
+            elif blockSize > 0xFF:
+                blockSize = 0
+            session.blockSize = blockSize
+
+
+# Frame sizes allowed by the CAN FD DLC, indexed by payload length
+FD_FRAME_SIZES = bytes([8, 8, 8, 8, 8, 8, 8, 8, 8,                                       #  0 -  8
+                        12, 12, 12, 12,                                                  #  9 - 12
+                        16, 16, 16, 16,                                                  # 13 - 16
+                        20, 20, 20, 20,                                                  # 17 - 20
+                        24, 24, 24, 24,                                                  # 21 - 24
+                        32, 32, 32, 32, 32, 32, 32, 32,                                  # 25 - 32
+                        48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48,  # 33 - 48
+                        64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64   # 49 - 64
+                        ])
+
+# Consecutive frame PCI bytes, indexed by sequence number
+CF_PCI = bytes(0x20 | i for i in range(16))
+
+PADDING = memoryview(bytes(64))
+
+
+class FramePool(object):
+    def __init__(self, count: int = 32):
+        self._count = count
+        self._frames = {}
+        self._index = {}
+
+    def get(self, size: int) -> bytearray:
+        frames = self._frames.get(size)
+        if frames is None:
+            frames = [bytearray(size) for _ in range(self._count)]
+            self._frames[size] = frames
+            self._index[size] = 0
+
+        # Buffers are recycled round robin, the send callback must be done
+        # with a frame before `count` more frames of its size are requested
+        idx = self._index[size]
+        self._index[size] = (idx + 1) % self._count
+
+        return frames[idx]
+
+
+class ISOTPTransfer(object):
+    def __init__(self, data, fd: bool, pool: FramePool):
+        try:
+            self._view = memoryview(data).cast('B')
+        except TypeError:
+            self._view = memoryview(bytes(data))
+
+        self._size = len(self._view)
+        self._fd = fd
+        self._pool = pool
+        self._cfSize = 63 if fd else 7
+        self._offset = 0
+        self._seq = 0
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def done(self):
+        return self._offset >= self._size
+
+    def firstFrame(self) -> bytearray:
+        view = self._view
+        size = self._size
+
+        # Single frame
+        if size <= 7:
+            frame = self._pool.get(8)
+            frame[0] = size
+            offset = 1
+        elif self._fd and size <= 62:
+            frame = self._pool.get(FD_FRAME_SIZES[size + 2])
+            frame[0] = 0
+            frame[1] = size
+            offset = 2
+
+        # First frame
+        elif size <= 0xFFF:
+            frame = self._pool.get(64 if self._fd else 8)
+            frame[0] = 0x10 | (size >> 8)
+            frame[1] = size & 0xFF
+            offset = 2
+
+        # First frame with escape sequence, 32 bit length
+        else:
+            if size > 0xFFFFFFFF:
+                raise Exception("PDU too large")
+
+            frame = self._pool.get(64 if self._fd else 8)
+            frame[0] = 0x10
+            frame[1] = 0x00
+            frame[2:6] = size.to_bytes(4, 'big')
+            offset = 6
+
+        n = min(size, len(frame) - offset)
+        frame[offset: offset + n] = view[:n]
+        self._pad(frame, offset + n)
+        self._offset = n
+
+        return frame
+
+    def nextFrame(self) -> bytearray:
+        offset = self._offset
+        n = min(self._cfSize, self._size - offset)
+
+        if self._fd:
+            frame = self._pool.get(FD_FRAME_SIZES[n + 1])
+        else:
+            frame = self._pool.get(8)
+
+        self._seq = (self._seq + 1) & 0xF
+        frame[0] = CF_PCI[self._seq]
+        frame[1: 1 + n] = self._view[offset: offset + n]
+        self._pad(frame, 1 + n)
+        self._offset = offset + n
+
+        return frame
+
+    def nextFrames(self, count: int) -> list:
+        frames = []
+        while count and not self.done:
+            frames.append(self.nextFrame())
+            count -= 1
+
+        return frames
+
+    def _pad(self, frame, length):
+        if length < len(frame):
+            frame[length:] = PADDING[:len(frame) - length]
+
+
+class ISOTPSession(object):
+    def __init__(self,
+                 rxid: int,
+                 txid: int,
+                 extended: bool,
+                 blockSize: int = 0,
+                 separationTime: int = 0,
+                 queueType=Queue,
+                 sink=None):
+        self.rxid = rxid
+        self.txid = txid
+        self.extended = extended
+
+        # Flow control parameters advertised to the sender
+        self.blockSize = blockSize
+        self.separationTime = separationTime
+
+        self.pdus = queueType()
+        self.flowControl = queueType()
+        # Called after a FC is queued, for senders that don't block on it
+        self.onFlowControl = None
+
+        # Where reassembled payloads go: a callback(chunk, offset, size), a
+        # file like object or a writable buffer. None allocates a bytearray
+        # per PDU.
+        self.sink = sink
+
+        # Reassembly state
+        self.active = False
+        self.data = None
+        self.view = None
+        self.size = 0
+        self.offset = 0
+        self.remaining = 0
+        self.seq = 0
+        self.lastRx = 0
+        self.blockLimit = 0
+        self.blockCount = 0
+        self.waiting = False
+        self.waitCount = 0
+        self.cleanPdus = 0
+
+        self.sequenceErrors = 0
+        self.timeouts = 0
+        self.overflows = 0
+
+    def begin(self, size):
+        self.size = size
+        self.offset = 0
+        self.remaining = size
+
+        sink = self.sink
+        if sink is None:
+            self.data = bytearray(size)
+            self.view = memoryview(self.data)
+        elif not callable(sink) and not hasattr(sink, 'write'):
+            self.view = memoryview(sink).cast('B')
+            if len(self.view) < size:
+                self.view = None
+                return False
+
+        return True
+
+    def write(self, chunk):
+        n = len(chunk)
+
+        if self.view is not None:
+            self.view[self.offset: self.offset + n] = chunk
+        elif callable(self.sink):
+            self.sink(chunk, self.offset, self.size)
+        else:
+            self.sink.write(chunk)
+
+        self.offset += n
+        self.remaining -= n
+
+    def finish(self):
+        # With a sink the application already has the data, report its size
+        if self.sink is None:
+            return self.data
+
+        return self.size
+
+    def reset(self):
+        self.active = False
+        self.data = None
+        self.view = None
+        self.remaining = 0
+        self.seq = 0
+        self.blockCount = 0
+        self.waiting = False
+        self.waitCount = 0
 
 
 class ISOTP(object):
+    _queueType = Queue
+
     def __init__(self,
                  recv: Callable[[int], CanMessage],
                  send: Callable[[int, bool, bool, bytearray], int],
                  rxid: int = 0x718,
                  txid: int = 0x710,
                  extended: bool = False,
-                 fd: bool = False):
+                 fd: bool = False,
+                 nCr: float = 1.0,
+                 nBs: float = 1.0,
+                 blockSize: int = 0,
+                 separationTime: int = 0,
+                 adaptive: AdaptiveFlowControl = None,
+                 spinThreshold: float = 0.002,
+                 onMissedDeadline: Callable[[float], None] = None,
+                 pool: FramePool = None,
+                 sendMany: Callable[[int, bool, bool, list], int] = None,
+                 maxBurst: int = 32,
+                 observer: Observer = None,
+                 maxSize: int = 0x100000):
         self._rxid = rxid
         self._txid = txid
         self._extended = extended
         self._recvFn = recv
         self._sendFn = send
         self._fd = fd
+        self._nCr = nCr
+        self._nBs = nBs
+        self._blockSize = blockSize
+        self._separationTime = separationTime
+        self._adaptive = adaptive
+        self._spinThreshold = spinThreshold
+        self._onMissedDeadline = onMissedDeadline
+        self._sendManyFn = sendMany
+        self._maxBurst = maxBurst
+        # A burst must not recycle any of its own frames
+        if pool is not None and pool._count <= maxBurst:
+            raise Exception("Frame pool must hold more than maxBurst frames")
+        self._pool = pool or FramePool(max(32, maxBurst + 1))
+
+        # Only wrap the transmit path when observed, so it costs nothing
+        # otherwise
+        self._observer = observer
+        if observer:
+            if send:
+                self._sendFn = self._observeSend(send)
+            if sendMany:
+                self._sendManyFn = self._observeSendMany(sendMany)
+
+        # Largest PDU a session may allocate a buffer for, sinks are only
+        # bound by the adaptive flow control maxSize
+        self._maxSize = maxSize
+
+        self.missedDeadlines = 0
+
+        # Reassembly sessions, indexed by the (rxid, extended) pair carried
+        # by incoming frames. Each session knows the txid used for its FC.
+        self._sessions = {}
+        # Sessions receiving the FC for transfers sent on (txid, extended)
+        self._senders = {}
+        self.open(rxid, txid, extended)
+
+    def open(self,
+             rxid: int,
+             txid: int,
+             extended: bool = None,
+             blockSize: int = None,
+             separationTime: int = None,
+             sink=None) -> ISOTPSession:
+        if None == extended:
+            extended = self._extended
+
+        if None == blockSize:
+            blockSize = self._blockSize
+
+        if None == separationTime:
+            separationTime = self._separationTime
+
+        session = self._sessions.get((rxid, extended))
+        if session is None or session.txid != txid:
+            previous = session
+            session = ISOTPSession(rxid, txid, extended, blockSize,
+                                   separationTime, self._queueType, sink)
+            self._sessions[(rxid, extended)] = session
+
+            if self._senders.get((txid, extended)) in (None, previous):
+                self._senders[(txid, extended)] = session
+        else:
+            session.blockSize = blockSize
+            session.separationTime = separationTime
+            session.sink = sink
 
-    def recv(self, timeout=2, id=None):
-        data = []
-        ff = False
-        multiFrameSize = 0
+        return session
 
-        if self._recvFn:
-            if None == id:
-                id = self._rxid
-            startTime = time()
-            while 1:
-                elapsed = (time() - startTime)
-
-                if elapsed >= timeout:
-                    raise Exception("Rx Timeout")
-
-                msg = self._recvFn(id)
-                if msg is not None:
-                    payload = msg.data()
-                    payloadSize = len(payload)
-
-                    # Invalid frame
-                    frameType = -1
-
-                    if payloadSize > 1:
-                        frameType = (payload[0] >> 4) & 0xF
-
-                    # Single Frame
-                    if 0 == frameType:
-                        size = payload[0] & 0xF
-                        if 0 == size and self._fd and payloadSize > 2:
-                            size = payloadSize[1]
-
-                            if payloadSize - 2 >= size:
-                                data = payload[2: 2 + size]
-                                break
-
-                        elif size >= 1 and size <= 7:
-                            if payloadSize - 1 >= size:
-                                data = payload[1: 1 + size]
-                                break
-
-                    # First frame
-                    elif 1 == frameType and payloadSize > 2:
-                        ff = True
-                        multiFrameSize = (
-                            payload[0] & 0xFF << 8 | payload[1] & 0xFF)
-
-                        if 0 == multiFrameSize and self._fd:
-                            # TODO: Handle the  size above 0xFFF
-                            pass
-                        else:
-                            self._sendFlowControl()
-                            data = payload[2:]
-                            multiFrameSize -= len(payload[2:])
-
-                    # Consecutive frame
-                    elif 2 == frameType and True == ff:
-                        startTime = time()
-                        tmp = payload[1:]
-
-                        if multiFrameSize > len(tmp):
-                            data += tmp
-                            multiFrameSize -= len(tmp)
-                        else:
-                            data += tmp[0: multiFrameSize]
-                            multiFrameSize = 0
-
-                        if 0 == multiFrameSize:
-                            ff = False
-                            break
-
-                    # Flow control
-                    elif 3 == frameType:
-                        data = payload
-                        break
-        return data
+    def close(self, rxid: int, extended: bool = None):
+        if None == extended:
+            extended = self._extended
 
-    def send(self, data, timeout=2, id=None, extended=None, fd=None):
-        extended = extended or self._extended
-        fd = fd or self._fd
+        session = self._sessions.pop((rxid, extended), None)
+        if session and self._senders.get((session.txid, extended)) is session:
+            del self._senders[(session.txid, extended)]
 
-        size = len(data)
-        if fd and size >= 8:
-            self._sendFD(data, size, timeout, id)
-        else:
-            self._send(data, size, timeout, id)
+    def feed(self, msg: CanMessage) -> bool:
+        session = self._sessions.get((msg.arbitrationId, msg.isExtended))
+        if session is None:
+            return False
 
-# private
-    def _sendFD(self, data, size, timeout, id=None):
-        if size >= 8 and size < 63:
-            self._sendSingleFrameFD(data, size, id)
-        elif size >= 63:
-            self._sendMultiFrameFD(data, size, timeout, id)
+        if self._observer:
+            self._observer.frameReceived((session.txid, session.rxid), msg.payload)
 
-    def _sendSingleFrameFD(self, data, size, id=None):
-        if self._sendFn:
-            if None == id:
-                id = self._txid
+        self._process(session, msg.payload, monotonic())
+        return True
 
-            arr = bytearray(self._getBuffSize(size + 2))
-            arr[1] = size & 0x3F
+    def poll(self, now: float = None):
+        if None == now:
+            now = monotonic()
 
-            for i in range(size):
-                arr[2 + i] = data[i]
+        for session in list(self._sessions.values()):
+            self._checkSession(session, now)
 
-            self._sendFn(id, self._extended, self._fd, arr)
+    def recv(self, timeout=2, id=None, extended=None):
+        if None == id:
+            id = self._rxid
 
-    def _sendMultiFrameFD(self, data, size, timeout, id=None):
-        if self._sendFn:
-            if None == id:
-                id = self._txid
+        if None == extended:
+            extended = self._extended
 
-            byteSent = 0
+        session = self._session(id, extended)
 
-            self._sendFirstFrameFD(data, size)
+        data = self._wait(session.pdus, timeout, id)
 
-            byteSent += 62
+        # The application made room, let a paused sender continue
+        if session.waiting and 0 == self._adaptive.status(session):
+            self._flowControl(session, monotonic())
 
-            # wait for flow control
-            flags, blockSize, separationTime = self._waitForFlowControl(
-                timeout)
+        return data
 
-            sleep(separationTime // 1000)
+    def send(self, data, timeout=None, id=None, extended=None, fd=None):
+        extended = extended or self._extended
+        fd = fd or self._fd
 
-            seq = 0
-            blockCount = 0
-            while 1:
-                toIdx = (byteSent + 63)
+        if None == id:
+            id = self._txid
 
-                if toIdx > size:
-                    toIdx = size
+        # Each FC wait is bounded by timeout, N_Bs unless given
+        if None == timeout:
+            timeout = self._nBs
 
-                arr = bytearray(self._getBuffSize(toIdx - byteSent))
-                seq = (seq + 1) % 0x10
+        # Drop any stale FC left over from a previous transfer
+        session = self._sender(id, extended)
+        while not session.flowControl.empty():
+            session.flowControl.get_nowait()
 
-                if blockSize != 0 and blockCount == blockSize:
-                    blockCount = 0
-                    # wait for flow control
-                    flags, blockSize, separationTime = self._waitForFlowControl(
-                        timeout)
+        if self._sendFn:
+            self._sendTransfer(ISOTPTransfer(data, fd, self._pool),
+                               id, extended, fd, session, timeout)
 
-                arr[0] = 0x20 | (seq & 0xF)
-                arrIdx = 1
+# private
+    def _sendTransfer(self, transfer, id, extended, fd, session, timeout):
+        self._sendFn(id, extended, fd, transfer.firstFrame())
+
+        if transfer.done:
+            return
+
+        # wait for flow control
+        flags, blockSize, separationTime = self._waitForFlowControl(
+            timeout, session)
+
+        pacer = self._makePacer()
+        pacer.start(separationTime)
+
+        blockCount = 0
+        while not transfer.done:
+            if blockSize != 0 and blockCount == blockSize:
+                blockCount = 0
+                # wait for flow control
+                flags, blockSize, separationTime = self._waitForFlowControl(
+                    timeout, session)
+                self._observeSeparationTime(session, pacer)
+                pacer.start(separationTime)
+
+            # Without STmin the rest of the block may go out back to back
+            if self._sendManyFn and 0 == separationTime:
+                count = self._maxBurst
+                if 0 != blockSize:
+                    count = min(count, blockSize - blockCount)
 
-                for i in range(byteSent, toIdx):
-                    arr[arrIdx] = data[i]
-                    arrIdx += 1
+                frames = transfer.nextFrames(count)
+                self._sendManyFn(id, extended, fd, frames)
 
-                self._sendFn(id, self._extended, self._fd, arr)
+                blockCount += len(frames)
+                continue
 
-                if 0 != blockSize:
-                    blockCount += 1
+            frame = transfer.nextFrame()
 
-                byteSent += toIdx - byteSent
+            pacer.wait()
+            self._sendFn(id, extended, fd, frame)
 
-                if size == byteSent:
-                    break
+            blockCount += 1
 
-                sleep(separationTime // 1000)
+        self._observeSeparationTime(session, pacer)
+        self.missedDeadlines += pacer.missed
 
-    def _sendFirstFrameFD(self, data, size, id=None):
-        if self._sendFD:
+    def _sendFlowControl(self, flag=0, blockSize=0, separationTime=0, id=None, extended=None):
+        if self._sendFn:
+            arr = bytearray(8)
+            arr[0] = 0x30 | (flag & 0x3)
+            arr[1] = blockSize
 
             if None == id:
                 id = self._txid
 
-            arr = bytearray(64)
-
-            arr[0] = 0x10
-
-            if (size >= 8) and (size <= 0xFFF):
-                arr[0] = (1 << 4) | ((size & 0xFFF) >> 8)
-                arr[1] = size & 0xFF
+            if None == extended:
+                extended = self._extended
 
-                for i in range(min(62, size)):
-                    arr[2 + i] = data[i]
+            arr[2] = separationTime
 
-                self._sendFn(id, self._extended, self._fd, arr)
-            elif size > 0xFFF:
-                arr[0] = 0x10
-                arr[1] = 0x00
+            self._sendFn(id, extended, self._fd, arr)
 
-                # Set the next 4 bytes as the size in high byte first order
-                for i in range(4):
-                    arr[2 + i] = (size >> (24 - i*8)) & 0xFF
+    def _makePacer(self):
+        return STminPacer(spinThreshold=self._spinThreshold,
+                          onMiss=self._onMissedDeadline)
 
-                # Copy the data
-                for i in range(60):
-                    arr[6 + i] = data[i]
+    def _waitForFlowControl(self, timeout, session):
 
-                self._sendFn(id, self._extended, self._fd, arr)
-
-    def _send(self, data, size, timeout, id=None):
-        if size > 0 and size < 8:
-            self._sendSingleFrame(data, size, id)
-        elif size >= 8:
-            self._sendMultiFrame(data, size, timeout, id)
-
-    def _sendFlowControl(self, flag=0, blockSize=0, separationTime=0, id=None):
-        if self._sendFn:
-            arr = bytearray(8)
-            arr[0] = 0x30 | (flag & 0x3)
-            arr[1] = blockSize
+        while 1:
+            start = monotonic()
+            flag, blockSize, separationTime = self._wait(
+                session.flowControl, timeout, session.rxid)
+
+            if self._observer:
+                self._observer.flowControl((session.txid, session.rxid),
+                                           flag, monotonic() - start)
+
+            # Wait, the receiver restarts our N_Bs timer
+            if 1 == flag:
+                continue
+            # Overflow
+            elif 2 == flag:
+                raise Exception("Flow control overflow")
+
+            return flag, blockSize, separationTime
+
+    def _wait(self, queue, timeout, id):
+        if self._recvFn is None:
+            try:
+                return queue.get(timeout=timeout)
+            except Empty:
+                raise Exception("Rx Timeout")
 
-            if None == id:
-                id = self._txid
+        # Legacy polling mode, drive the state machine from the recv callback
+        deadline = monotonic() + timeout
+        while 1:
+            try:
+                return queue.get_nowait()
+            except Empty:
+                pass
 
-            self._sendFn(id, self._extended, self._fd, arr)
+            now = monotonic()
+            if now >= deadline:
+                raise Exception("Rx Timeout")
 
-    def _sendSingleFrame(self, data, size, id=None):
-        if self._sendFn:
-            arr = bytearray(8)
-            arr[0] = size & 0xFF
+            self.poll(now)
 
-            for i in range(size):
-                arr[1 + i] = data[i]
+            msg = self._recvFn(id)
+            if msg is not None:
+                self.feed(msg)
 
-            if None == id:
-                id = self._txid
+    def _sender(self, txid, extended):
+        session = self._senders.get((txid, extended))
+        if session is None:
+            session = self._session(self._rxid, self._extended)
 
-            self._sendFn(id, self._extended, self._fd, arr)
+        return session
 
-    def _sendMultiFrame(self, data, size, timeout, id=None):
-        if self._sendFn:
-            arr = bytearray(8)
+    def _session(self, rxid, extended):
+        session = self._sessions.get((rxid, extended))
+        if session is None:
+            session = self.open(rxid, self._txid, extended)
 
-            if None == id:
-                id = self._txid
+        return session
 
-            byteSent = 0
+    def _checkSession(self, session, now):
+        if session.waiting:
+            if (0 == self._adaptive.status(session)
+                    or now - session.lastRx >= self._adaptive.waitInterval):
+                self._flowControl(session, now)
+        elif session.active and now - session.lastRx > self._nCr:
+            self._drop(session)
+            self._timeout(session)
 
-            # Preparing the first frame
-            arr[0] = (1 << 4) | ((size & 0xFFF) >> 8)
-            arr[1] = size & 0xFF
+    def _process(self, session, payload, now):
+        payloadSize = len(payload)
+        if payloadSize < 2:
+            return
 
-            for i in range(6):
-                arr[2 + i] = data[i]
+        if session.active and now - session.lastRx > self._nCr:
+            self._drop(session)
+            self._timeout(session)
 
-            byteSent += self._sendFn(id, self._extended, self._fd, arr)
+        frameType = (payload[0] >> 4) & 0xF
 
-            # wait for flow control
-            flags, blockSize, separationTime = self._waitForFlowControl(
-                timeout)
+        # Single Frame
+        if 0 == frameType:
+            size = payload[0] & 0xF
+            offset = 1
 
-            sleep(separationTime // 1000)
+            if 0 == size and payloadSize > 8:
+                size = payload[1]
+                offset = 2
 
-            seq = 0
-            blockCount = 0
-            while 1:
-                arr = bytearray(8)
-                seq = (seq + 1) % 0x10
+            if 0 == size or payloadSize - offset < size:
+                return
+
+            # A new SF terminates any reception in progress
+            session.reset()
+
+            if not session.begin(size):
+                self._overflow(session)
+                return
+
+            session.write(payload[offset: offset + size])
+            session.pdus.put_nowait(session.finish())
+            session.reset()
+
+        # First frame
+        elif 1 == frameType:
+            size = ((payload[0] & 0xF) << 8) | payload[1]
+            offset = 2
+
+            # Escape sequence, 32 bit length for PDUs above 4095 bytes
+            if 0 == size:
+                if payloadSize < 8:
+                    return
+
+                size = int.from_bytes(payload[2:6], 'big')
+                offset = 6
+
+                if size <= 0xFFF:
+                    return
+
+            session.reset()
+
+            # The length is checked before begin() allocates anything for it
+            if not self._accepts(session, size) or not session.begin(size):
+                self._overflow(session)
+                self._sendFlowControl(2, 0, 0, session.txid, session.extended)
+                session.reset()
+                return
+
+            session.active = True
+            session.seq = 1
+
+            self._flowControl(session, now, size)
+
+            if session.active:
+                session.write(payload[offset: offset + size])
+
+        # Consecutive frame
+        elif 2 == frameType:
+            if not session.active:
+                return
+
+            if (payload[0] & 0xF) != session.seq:
+                self._drop(session)
+                self._sequenceError(session)
+                return
+
+            session.seq = (session.seq + 1) & 0xF
+            session.lastRx = now
+
+            session.write(payload[1: 1 + session.remaining])
+
+            if 0 == session.remaining:
+                session.pdus.put_nowait(session.finish())
+                session.reset()
+
+                if self._adaptive:
+                    self._adaptive.onComplete(session)
+
+            elif 0 != session.blockLimit:
+                session.blockCount += 1
+                if session.blockCount == session.blockLimit:
+                    self._flowControl(session, now)
+
+        # Flow control
+        elif 3 == frameType and payloadSize >= 3:
+            session.flowControl.put_nowait((payload[0] & 0xF, payload[1], payload[2]))
+
+            if session.onFlowControl:
+                session.onFlowControl()
+
+    def _flowControl(self, session, now, size=None):
+        flag = 0
+        if self._adaptive:
+            flag = self._adaptive.status(session, size)
+
+            if 1 == flag and session.waitCount >= self._adaptive.maxWait:
+                # N_WFTmax reached, overflow is only allowed in reply to a FF
+                if size is None:
+                    self._overflow(session)
+                    session.reset()
+                    return
+                flag = 2
+
+        if 0 == flag:
+            session.waiting = False
+            session.waitCount = 0
+            session.blockCount = 0
+            session.blockLimit = session.blockSize
+        elif 1 == flag:
+            session.waiting = True
+            session.waitCount += 1
+        else:
+            self._overflow(session)
+            session.reset()
 
-                if blockSize != 0 and blockCount == blockSize:
-                    blockCount = 0
-                    # wait for flow control
-                    flags, blockSize, separationTime = self._waitForFlowControl(
-                        timeout)
+        session.lastRx = now
 
-                arr[0] = 0x20 | (seq & 0xF)
-                arrIdx = 1
-                toIdx = (byteSent + 7)
+        self._sendFlowControl(flag, session.blockSize, session.separationTime,
+                              session.txid, session.extended)
 
-                if toIdx > size:
-                    toIdx = size
+    def _accepts(self, session, size):
+        if self._adaptive and size > self._adaptive.maxSize:
+            return False
 
-                for i in range(byteSent, toIdx):
-                    arr[arrIdx] = data[i]
-                    arrIdx += 1
+        return session.sink is not None or size <= self._maxSize
 
-                self._sendFn(id, self._extended, self._fd, arr)
+    def _drop(self, session):
+        session.reset()
 
-                if 0 != blockSize:
-                    blockCount += 1
+        if self._adaptive:
+            self._adaptive.onDrop(session)
 
-                byteSent += toIdx - byteSent
+    def _sequenceError(self, session):
+        session.sequenceErrors += 1
+        if self._observer:
+            self._observer.sequenceError((session.txid, session.rxid))
 
-                if size == byteSent:
-                    break
+    def _timeout(self, session):
+        session.timeouts += 1
+        if self._observer:
+            self._observer.rxTimeout((session.txid, session.rxid))
 
-                sleep(separationTime // 1000)
+    def _overflow(self, session):
+        session.overflows += 1
+        if self._observer:
+            self._observer.overflow((session.txid, session.rxid))
 
-    def _waitForFlowControl(self, timeout):
-        startTime = time()
+    def _observeSeparationTime(self, session, pacer):
+        if self._observer:
+            achieved = pacer.achieved()
+            if None != achieved:
+                self._observer.separationTime((session.txid, session.rxid),
+                                              pacer.requested, achieved)
 
-        while 1:
-            elapsed = (time() - startTime)
-            if elapsed >= timeout:
-                raise Exception("Rx Timeout")
+    def _connection(self, id, extended):
+        session = self._senders.get((id, extended))
+        return (id, session.rxid if session else None)
 
-            if self._recvFn:
-                msg = self._recvFn(self._rxid)
+    def _observeSend(self, send):
+        observer = self._observer
 
-                if msg:
-                    data = msg.data()
-                    frameType = ((data[0] >> 4) & 0xF)
-                    if 3 == frameType and len(data) >= 3:
-                        return (data[0] & 0xF), data[1], data[2]
+        def observed(id, extended, fd, data):
+            ret = send(id, extended, fd, data)
+            observer.frameSent(self._connection(id, extended), 1, len(data))
+            return ret
 
-    def _getBuffSize(self, size):
-        r = 0
+        return observed
 
-        if size >= 0 and size <= 64:
-            arr = [8, 8, 8, 8, 8, 8, 8, 8, 8,                                       #  0 -  8
-                   12, 12, 12, 12,                                                  #  9 - 12
-                   16, 16, 16, 16,                                                  # 13 - 16
-                   20, 20, 20, 20,                                                  # 17 - 20
-                   24, 24, 24, 24,                                                  # 21 - 24
-                   32, 32, 32, 32, 32, 32, 32, 32,                                  # 25 - 32
-                   48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48, 48,  # 33 - 48
-                   64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64, 64   # 49 - 64
-                   ]
+    def _observeSendMany(self, sendMany):
+        observer = self._observer
 
-            r = arr[size]
+        def observed(id, extended, fd, frames):
+            ret = sendMany(id, extended, fd, frames)
+            observer.frameSent(self._connection(id, extended), len(frames),
+                               sum(len(frame) for frame in frames))
+            return ret
 
-        return r
+        return observed
@@ -13,7 +13,12 @@
 # limitations under the License.
 from collections.abc import Callable
 from .datatypes import CanMessage
-from time import time, sleep
+from .didcache import DIDCache
+from .download import DownloadEncoder, DownloadResult, DownloadSource, parseMaxBlockLength, DEFAULT_BLOCK_LENGTH
+from .metrics import Observer
+from .periodic import PeriodicSubscription, PERIODIC_DID_BASE
+from time import time, sleep, perf_counter
+from zlib import crc32
 from typing import Tuple
 from enum import Enum
 
@@ -25,13 +30,24 @@ class UDS:
                  extended: bool,
                  recv: Callable[[int, int], bytearray],
                  send: Callable[[bytearray, int, int, bool, bool, ], int],
-                 fd: bool = False):
+                 fd: bool = False,
+                 observer: Observer = None,
+                 didLengths: dict = None,
+                 cache: DIDCache = None):
         self._rxid = rxid
         self._txid = txid
         self._extended = extended
         self._recvFn = recv
         self._sendFn = send
         self._fd = fd
+        self._observer = observer
+        # Connection and service of the last request, for the observer
+        self._conn = None
+        self._sid = None
+        # Record length of each DID, needed to split multi DID responses
+        self._didLengths = dict(didLengths or {})
+        # Opt-in cache of DID values, keyed by request id
+        self._cache = cache
 
     # Diagnostic Session Control
     def setSession(self, v: int,
@@ -53,10 +69,14 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
+
+        # Values may depend on the session
+        if self._cache is not None:
+            self._cache.flush(txid)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x10 + 0x40, 2, 3)
+            ret, data = self._handleResponse(rxid, 0x10 + 0x40, 2, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -90,10 +110,13 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
+
+        if self._cache is not None:
+            self._cache.flush(txid)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x11 + 0x40, 2, 3)
+            ret, data = self._handleResponse(rxid, 0x11 + 0x40, 2, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -120,10 +143,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x27 + 0x40, 2, 3)
+            ret, data = self._handleResponse(rxid, 0x27 + 0x40, 2, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -152,10 +175,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x27 + 0x40, 2, 3)
+            ret, data = self._handleResponse(rxid, 0x27 + 0x40, 2, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -178,10 +201,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x3E + 0x40, 1, 3)
+            ret, data = self._handleResponse(rxid, 0x3E + 0x40, 1, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -196,28 +219,149 @@ class UDS:
                              rxid: int = None,
                              extended: bool = None,
                              fd: bool = None) -> Tuple[bool, bytearray]:
-        payload = bytearray([0x22])
+        cache = self._cache if waitResponse and not params else None
+
+        if cache is not None:
+            data = cache.get(txid or self._txid, id)
+            if data is not None:
+                return True, data
+
+        ret, data = self._readDataByIdentifier(id, params, timeout, waitResponse,
+                                               txid, rxid, extended, fd)
+
+        if cache is not None and ret:
+            cache.put(txid or self._txid, id, data)
+
+        return ret, data
+    
+    def registerDID(self, id: int, length: int):
+        self._didLengths[id] = length
+
+    # Read Data By Identifier, several DIDs per request
+    def readDataByIdentifiers(self,
+                              ids: list,
+                              maxSize: int = 4095,
+                              maxPerRequest: int = 0,
+                              timeout: int = 2,
+                              txid: int = None,
+                              rxid: int = None,
+                              extended: bool = None,
+                              fd: bool = None) -> Tuple[bool, dict]:
         if self._sendFn is None:
-            return False, []
+            return False, {}
 
-        payload += self._int2bytes(id)
+        ids = list(dict.fromkeys(ids))
 
-        if params:
-            payload += params
+        txid = txid or self._txid
+        rxid = rxid or self._rxid
+        extended = extended or self._extended
+        fd = fd or self._fd
+
+        values = {}
+        missing = ids
+        if self._cache is not None:
+            for id in ids:
+                data = self._cache.get(txid, id)
+                if data is not None:
+                    values[id] = data
+            missing = [id for id in ids if id not in values]
+
+        fetched = {}
+        for batch in self._didBatches(missing, maxSize, maxPerRequest):
+            single = 1 == len(batch)
+
+            if not single:
+                payload = bytearray([0x22])
+                for id in batch:
+                    payload += id.to_bytes(2, 'big')
+
+                self._send(payload, timeout, txid, rxid, extended, fd)
+                ret, data = self._handleResponse(rxid, 0x22 + 0x40, 1, max(timeout, 3))
+
+                if ret:
+                    records = self._splitDIDs(batch, data)
+                    if records is not None:
+                        fetched.update(records)
+                        continue
+
+                # Too many DIDs or too long a response for this ECU, ask one
+                # by one. Any other NRC applies to the whole batch.
+                elif len(data) < 2 or data[1] not in (0x13, 0x14):
+                    continue
+
+            for id in batch:
+                ret, data = self._readDataByIdentifier(id, None, timeout, True,
+                                                       txid, rxid, extended, fd)
+                if ret:
+                    fetched[id] = data
+
+        if self._cache is not None:
+            for id, data in fetched.items():
+                self._cache.put(txid, id, data)
+
+        values.update(fetched)
+        return len(values) == len(ids), values
+
+    # Read Data By Periodic Identifier
+    class PeriodicRate:
+        SLOW = 0x01
+        MEDIUM = 0x02
+        FAST = 0x03
+        STOP = 0x04
+
+    def readDataByPeriodicIdentifier(self,
+                                     mode: PeriodicRate | int,
+                                     ids: list,
+                                     timeout: int = 2,
+                                     waitResponse=True,
+                                     txid: int = None,
+                                     rxid: int = None,
+                                     extended: bool = None,
+                                     fd: bool = None) -> Tuple[bool, bytearray]:
+        # Periodic DIDs are sent as their low byte
+        payload = bytearray([0x2A, mode]) + bytearray(id & 0xFF for id in ids)
+
+        if self._sendFn is None:
+            return False, []
 
         txid = txid or self._txid
         rxid = rxid or self._rxid
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x22 + 0x40, 3, 3)
+            ret, data = self._handleResponse(rxid, 0x2A + 0x40, 1, max(timeout, 3))
             return ret, data
         else:
             return True, []
-    
+
+    def subscribe(self,
+                  ids: list,
+                  rate: PeriodicRate | int = PeriodicRate.FAST,
+                  maxBuffered: int = 1024,
+                  onSample: Callable = None,
+                  dispatcher=None,
+                  periodicId: int = None,
+                  timeout: int = 2) -> Tuple[bool, PeriodicSubscription]:
+        # With a dispatcher the periodic frames on periodicId are routed to
+        # the subscription, otherwise feed it the frames yourself
+        dids = [PERIODIC_DID_BASE | (id & 0xFF) for id in ids]
+        lengths = {did: self._didLengths[did] for did in dids if did in self._didLengths}
+
+        subscription = PeriodicSubscription(self, ids, rate, maxBuffered, onSample,
+                                            lengths, dispatcher, periodicId,
+                                            self._extended)
+
+        ret, data = self.readDataByPeriodicIdentifier(rate, ids, timeout)
+        if not ret:
+            subscription.active = False
+            if dispatcher is not None:
+                dispatcher.disconnect(subscription)
+
+        return ret, subscription
+
     # Write Data By Identifier
     def writeDataByIdentifier(self,
                               id: int,
@@ -242,10 +386,13 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
+
+        if self._cache is not None:
+            self._cache.invalidate(txid, id)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x2E + 0x40, 3, 3)
+            ret, data = self._handleResponse(rxid, 0x2E + 0x40, 3, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -314,10 +461,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x31 + 0x40, 4, 3)
+            ret, data = self._handleResponse(rxid, 0x31 + 0x40, 4, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -370,10 +517,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x34 + 0x40, 1, 3)
+            ret, data = self._handleResponse(rxid, 0x34 + 0x40, 1, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -400,10 +547,10 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x36 + 0x40, 1, 3)
+            ret, data = self._handleResponse(rxid, 0x36 + 0x40, 1, max(timeout, 3))
             return ret, data
         else:
             return True, []
@@ -426,14 +573,94 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x37 + 0x40, 1, 3)
+            ret, data = self._handleResponse(rxid, 0x37 + 0x40, 1, max(timeout, 3))
             return ret, data
         else:
             return True, []
 
+    # Download, Request Download + Transfer Data blocks + Request Transfer Exit
+    def download(self,
+                 addr: int,
+                 source,
+                 size: int = None,
+                 fmt: int = 0,
+                 maxBlockLength: int = None,
+                 checksum: Callable = crc32,
+                 onProgress: Callable[[DownloadResult], None] = None,
+                 encoder: DownloadEncoder = None,
+                 timeout: int = 5,
+                 txid: int = None,
+                 rxid: int = None,
+                 extended: bool = None,
+                 fd: bool = None) -> Tuple[bool, DownloadResult]:
+        with DownloadSource(source, size) as image:
+            result = DownloadResult(image.size)
+            start = perf_counter()
+
+            ret, data = self.requestDownload(addr, image.size, fmt, timeout, True,
+                                             txid, rxid, extended, fd)
+            result.response = data
+            if not ret:
+                return False, result
+
+            # maxNumberOfBlockLength counts the SID and the sequence counter
+            blockLength = parseMaxBlockLength(data) or DEFAULT_BLOCK_LENGTH
+            if maxBlockLength:
+                blockLength = min(blockLength, maxBlockLength)
+            if blockLength <= 2:
+                raise Exception("Block length %d leaves no room for data" % blockLength)
+            result.blockLength = blockLength
+
+            def update(data):
+                if None == result.checksum:
+                    result.checksum = checksum(data)
+                else:
+                    result.checksum = checksum(data, result.checksum)
+
+                result.processed += len(data)
+
+            # With an encoder the checksum covers the image, not what is sent
+            if encoder:
+                blocks = encoder.blocks(image, blockLength - 2, update)
+            else:
+                blocks = image.blocks(blockLength - 2)
+
+            seq = 1
+            try:
+                for block in blocks:
+                    with block:
+                        ret, data = self.transferData(seq, block, timeout, True,
+                                                      txid, rxid, extended, fd)
+                        result.response = data
+                        if not ret:
+                            result.elapsed = perf_counter() - start
+                            return False, result
+
+                        if not encoder:
+                            update(block)
+
+                        result.sent += len(block)
+
+                    result.blocks += 1
+                    result.elapsed = perf_counter() - start
+                    # The counter wraps from 0xFF to 0x00
+                    seq = (seq + 1) & 0xFF
+
+                    if onProgress:
+                        onProgress(result)
+            finally:
+                # Stops the encoder's workers when the transfer is aborted
+                blocks.close()
+
+            ret, data = self.transferExit(timeout, True, txid, rxid, extended, fd)
+            result.response = data
+            result.elapsed = perf_counter() - start
+
+            return ret, result
+
     # Control DTC Settings
     class DTCSettings:
         ON = 1,
@@ -459,27 +686,43 @@ class UDS:
         extended = extended or self._extended
         fd = fd or self._fd
 
-        self._sendFn(payload, timeout, txid, extended, fd)
+        self._send(payload, timeout, txid, rxid, extended, fd)
 
         if waitResponse:
-            ret, data = self._handleResponse(rxid, 0x85 + 0x40, 2, 3)
+            ret, data = self._handleResponse(rxid, 0x85 + 0x40, 2, max(timeout, 3))
             return ret, data
         else:
             return True, []
 # private
 
+    def _send(self, payload, timeout, txid, rxid, extended, fd):
+        if self._observer:
+            self._conn = (txid, rxid)
+            self._sid = payload[0]
+            self._observer.request(self._conn, self._sid)
+
+        return self._sendFn(payload, timeout, txid, extended, fd)
+
     def _handleResponse(self, id, expectedPositiveResponse, offset=3, timeout=3):
         if self._recvFn:
             startTime = time()
+            observer = self._observer
 
             while 1:
                 elapsed = (time() - startTime)
 
                 if elapsed >= timeout:
-                    print("uds timeout")
+                    if observer:
+                        observer.responseTimeout(self._conn, self._sid)
                     break
 
-                data = self._recvFn(timeout, id)
+                try:
+                    data = self._recvFn(timeout, id)
+                except Exception:
+                    if observer:
+                        observer.responseTimeout(self._conn, self._sid)
+                    raise
+
                 if data and len(data):
                     if expectedPositiveResponse == data[0]:
                         tmp = []
@@ -487,17 +730,93 @@ class UDS:
                         if offset <= len(data):
                             tmp = data[offset:]
 
+                        if observer:
+                            observer.response(self._conn, self._sid)
+
                         return True, tmp
                     elif 0x7f == data[0]:
                         # we need to wait
                         if 0x78 == data[2]:
                             startTime = time()
-                            pass
+                            if observer:
+                                observer.pending(self._conn, self._sid)
                         else:
+                            if observer:
+                                observer.response(self._conn, self._sid, data[2])
+
                             return False, data[1:]
             return False, []
 
-    def _int2bytes(self, int: int):
-        from math import ceil, log
+    def _readDataByIdentifier(self,
+                              id: int,
+                              params: bytearray = None,
+                              timeout: int = 2,
+                              waitResponse=True,
+                              txid: int = None,
+                              rxid: int = None,
+                              extended: bool = None,
+                              fd: bool = None) -> Tuple[bool, bytearray]:
+        payload = bytearray([0x22])
+        if self._sendFn is None:
+            return False, []
+
+        payload += self._int2bytes(id)
 
-        return int.to_bytes(ceil(log(int)/log(256)))
+        if params:
+            payload += params
+
+        txid = txid or self._txid
+        rxid = rxid or self._rxid
+        extended = extended or self._extended
+        fd = fd or self._fd
+
+        self._send(payload, timeout, txid, rxid, extended, fd)
+
+        if waitResponse:
+            ret, data = self._handleResponse(rxid, 0x22 + 0x40, 3, max(timeout, 3))
+            return ret, data
+        else:
+            return True, []
+
+    def _didBatches(self, ids, maxSize, maxPerRequest):
+        # Request and response must both fit in maxSize. A DID of unknown
+        # length can't be split out of a response, it goes alone.
+        batch = []
+        responseSize = 1
+        for id in ids:
+            length = self._didLengths.get(id)
+            if None == length:
+                yield [id]
+                continue
+
+            if batch and (responseSize + 2 + length > maxSize
+                          or 1 + 2 * (len(batch) + 1) > maxSize
+                          or len(batch) == maxPerRequest):
+                yield batch
+                batch = []
+                responseSize = 1
+
+            batch.append(id)
+            responseSize += 2 + length
+
+        if batch:
+            yield batch
+
+    def _splitDIDs(self, ids, data):
+        # The ECU leaves out the DIDs it doesn't support
+        records = {}
+        offset = 0
+        while offset < len(data):
+            id = int.from_bytes(bytes(data[offset: offset + 2]), 'big')
+            length = self._didLengths.get(id) if id in ids else None
+            if None == length or offset + 2 + length > len(data):
+                return None
+
+            records[id] = data[offset + 2: offset + 2 + length]
+            offset += 2 + length
+
+        return records
+
+    def _int2bytes(self, int: int):
+        # Identifiers are at least two bytes
+        return int.to_bytes(max(2, (int.bit_length() + 7) // 8), 'big')
@@ -0,0 +1,291 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from heapq import heappush, heappop
+from itertools import count
+from .pacing import decodeSTmin
+from .pyisotp import ISOTP, ISOTPTransfer
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+
+class TxJob(object):
+    FIRST_FRAME = 0
+    WAIT_FLOW_CONTROL = 1
+    CONSECUTIVE_FRAME = 2
+
+    def __init__(self, conn, session, transfer, id, extended, fd, priority):
+        self.conn = conn
+        self.session = session
+        self.transfer = transfer
+        self.id = id
+        self.extended = extended
+        self.fd = fd
+        self.priority = priority
+        self.future = Future()
+
+        self.state = TxJob.FIRST_FRAME
+        self.deadline = 0
+        self.blockSize = 0
+        self.blockCount = 0
+        self.interval = 0
+
+
+class TxChannel(object):
+    def __init__(self, scheduler, conn: ISOTP, priority: int):
+        self._scheduler = scheduler
+        self._conn = conn
+        self._priority = priority
+
+    def send(self, data, timeout=2, id=None, extended=None, fd=None):
+        job = self._scheduler._submit(self._conn, data, self._priority,
+                                      id, extended, fd)
+        try:
+            return job.future.result(timeout)
+        except TimeoutError:
+            # Give the session to the next transfer, unless this one just
+            # finished after all
+            self._scheduler._abort(job, Exception("Tx Timeout"))
+            return job.future.result()
+
+    def recv(self, timeout=2, id=None, extended=None):
+        return self._conn.recv(timeout, id, extended)
+
+
+class TxScheduler(object):
+    def __init__(self, maxBurst: int = 32):
+        self._maxBurst = maxBurst
+        self._seq = count()
+
+        # Jobs allowed to send now, by (priority, arrival)
+        self._ready = []
+        # Jobs held back by STmin, by release time
+        self._pending = []
+        # Jobs waiting for a FC
+        self._waiting = []
+        # Jobs queued behind another transfer on the same session
+        self._backlog = {}
+
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._running = False
+
+    def channel(self, conn: ISOTP, priority: int = 0) -> TxChannel:
+        self._check(conn)
+        return TxChannel(self, conn, priority)
+
+    def submit(self, conn: ISOTP, data, priority: int = 0,
+               id=None, extended=None, fd=None) -> Future:
+        return self._submit(conn, data, priority, id, extended, fd).future
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._running = True
+        self._thread = Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run(self):
+        while self._running:
+            # Cleared before looking at the queues so no wakeup is lost
+            self._wakeup.clear()
+            now = perf_counter()
+
+            with self._lock:
+                self._collect(now)
+
+                job = heappop(self._ready)[2] if self._ready else None
+                timeout = self._timeout(now)
+
+            if job is not None:
+                self._step(job, now)
+                continue
+
+            self._wakeup.wait(timeout)
+
+# private
+    def _check(self, conn):
+        # Nobody would poll a recv callback while the scheduler waits for a FC
+        if conn._recvFn is not None:
+            raise Exception("TxScheduler needs a dispatcher fed connection")
+
+    def _submit(self, conn, data, priority, id, extended, fd):
+        self._check(conn)
+
+        extended = extended or conn._extended
+        fd = fd or conn._fd
+
+        if None == id:
+            id = conn._txid
+
+        session = conn._sender(id, extended)
+        job = TxJob(conn, session, ISOTPTransfer(data, fd, conn._pool),
+                    id, extended, fd, priority)
+
+        with self._lock:
+            # One transfer at a time per sender, the FC can't tell them apart
+            backlog = self._backlog.get(session)
+            if backlog is None:
+                self._backlog[session] = deque()
+                self._start(job)
+            else:
+                backlog.append(job)
+
+        self._wakeup.set()
+
+        return job
+
+    def _start(self, job):
+        session = job.session
+
+        # Drop any stale FC left over from a previous transfer
+        while not session.flowControl.empty():
+            session.flowControl.get_nowait()
+
+        session.onFlowControl = self._wakeup.set
+        self._schedule(job)
+
+    def _schedule(self, job):
+        heappush(self._ready, (job.priority, next(self._seq), job))
+
+    def _collect(self, now):
+        while self._pending and self._pending[0][0] <= now:
+            self._schedule(heappop(self._pending)[2])
+
+        waiting = []
+        for job in self._waiting:
+            if job.future.done():
+                continue
+
+            flowControl = job.session.flowControl
+
+            while not flowControl.empty() and TxJob.WAIT_FLOW_CONTROL == job.state:
+                flag, blockSize, separationTime = flowControl.get_nowait()
+
+                if job.conn._observer:
+                    job.conn._observer.flowControl(
+                        (job.session.txid, job.session.rxid), flag,
+                        now - job.deadline + job.conn._nBs)
+
+                # Wait, the receiver restarts our N_Bs timer
+                if 1 == flag:
+                    job.deadline = now + job.conn._nBs
+                # Overflow
+                elif 2 == flag:
+                    self._finish(job, Exception("Flow control overflow"))
+                    job.state = None
+                else:
+                    job.state = TxJob.CONSECUTIVE_FRAME
+                    job.blockSize = blockSize
+                    job.blockCount = 0
+                    job.interval = decodeSTmin(separationTime)
+                    self._schedule(job)
+
+            if TxJob.WAIT_FLOW_CONTROL != job.state:
+                continue
+
+            if now >= job.deadline:
+                self._finish(job, Exception("Rx Timeout"))
+            else:
+                waiting.append(job)
+
+        self._waiting = waiting
+
+    def _timeout(self, now):
+        deadlines = [job.deadline for job in self._waiting]
+        if self._pending:
+            deadlines.append(self._pending[0][0])
+
+        if not deadlines:
+            return None
+
+        return max(0, min(deadlines) - now)
+
+    def _step(self, job, now):
+        if job.future.done():
+            # Aborted while queued
+            return
+
+        conn = job.conn
+        transfer = job.transfer
+
+        try:
+            if TxJob.FIRST_FRAME == job.state:
+                conn._sendFn(job.id, job.extended, job.fd, transfer.firstFrame())
+            elif 0 == job.interval:
+                # The connection's pool only covers its own burst size
+                n = min(self._maxBurst, conn._maxBurst)
+                if 0 != job.blockSize:
+                    n = min(n, job.blockSize - job.blockCount)
+
+                frames = transfer.nextFrames(n)
+                if conn._sendManyFn:
+                    conn._sendManyFn(job.id, job.extended, job.fd, frames)
+                else:
+                    for frame in frames:
+                        conn._sendFn(job.id, job.extended, job.fd, frame)
+
+                job.blockCount += len(frames)
+            else:
+                conn._sendFn(job.id, job.extended, job.fd, transfer.nextFrame())
+                job.blockCount += 1
+        except Exception as e:
+            self._abort(job, e)
+            return
+
+        with self._lock:
+            if job.future.done():
+                return
+
+            if transfer.done:
+                self._finish(job, None)
+            elif (TxJob.FIRST_FRAME == job.state
+                  or (0 != job.blockSize and job.blockCount == job.blockSize)):
+                job.state = TxJob.WAIT_FLOW_CONTROL
+                job.deadline = now + conn._nBs
+                self._waiting.append(job)
+            elif 0 == job.interval:
+                self._schedule(job)
+            else:
+                heappush(self._pending,
+                         (perf_counter() + job.interval, next(self._seq), job))
+
+    def _abort(self, job, error):
+        with self._lock:
+            if not job.future.done():
+                self._finish(job, error)
+
+    def _finish(self, job, error):
+        if error is None:
+            job.future.set_result(job.transfer.size)
+        else:
+            job.future.set_exception(error)
+
+        backlog = self._backlog[job.session]
+        if backlog:
+            self._start(backlog.popleft())
+        else:
+            del self._backlog[job.session]
+            job.session.onFlowControl = None
@@ -0,0 +1,290 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import select
+import socket
+import struct
+from collections import deque
+from .datatypes import CanMessage, CanFrameRing
+from time import time
+
+CAN_EFF_FLAG = 0x80000000
+CAN_RTR_FLAG = 0x40000000
+CAN_ERR_FLAG = 0x20000000
+CAN_EFF_MASK = 0x1FFFFFFF
+CAN_SFF_MASK = 0x000007FF
+
+CAN_MTU = 16
+CANFD_MTU = 72
+CANFD_BRS = 0x01
+
+# Not exported by the socket module, value from asm-generic/socket.h
+SO_TIMESTAMPNS = getattr(socket, 'SO_TIMESTAMPNS', 35)
+
+# struct can_frame / struct canfd_frame header: can_id, len, flags, res0, res1
+FRAME_HEADER = struct.Struct('=IBBBB')
+FILTER = struct.Struct('=II')
+# struct timespec, native layout: two longs of the platform's size
+TIMESPEC = struct.Struct('@ll')
+
+
+class SocketCAN(object):
+    def __init__(self,
+                 channel: str = None,
+                 fd: bool = False,
+                 ids=None,
+                 bitrateSwitch: bool = True,
+                 timeout: float = 0.01,
+                 batch: int = 64,
+                 sock: socket.socket = None,
+                 ring: CanFrameRing = None,
+                 backlog: int = 256):
+        self._fd = fd
+        self._bitrateSwitch = bitrateSwitch
+        self._timeout = timeout
+        self._batch = batch
+
+        if sock is None:
+            sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+            if fd:
+                sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FD_FRAMES, 1)
+            sock.bind((channel,))
+
+        self._sock = sock
+        self._sock.setblocking(False)
+
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+            self._kernelTimestamps = True
+        except OSError:
+            self._kernelTimestamps = False
+
+        # With a ring, frames are read straight into its records instead of
+        # being copied out of one shared buffer.
+        if ring is not None and ring.claim().nbytes < CANFD_MTU:
+            raise Exception("Ring frames must hold %d bytes" % CANFD_MTU)
+
+        self._ring = ring
+
+        # Frames read from the socket but not yet asked for, one bounded queue
+        # per id so a busy id can't starve or bloat the others. Entries carry
+        # an arrival number to keep recv() without an id in order.
+        self._rx = {}
+        self._backlog = backlog
+        self._arrival = 0
+        self.dropped = 0
+        self._rxBuffer = bytearray(CANFD_MTU)
+        self._txBuffer = bytearray(CANFD_MTU * batch)
+        self._ancillarySize = socket.CMSG_SPACE(TIMESPEC.size)
+
+        # Software filter, only used when the kernel can't filter for us
+        self._accept = None
+
+        if ids is not None:
+            self.setFilters([(id, extended) for id, extended in ids])
+
+    def setFilters(self, ids):
+        filters = bytearray()
+        for id, extended in ids:
+            if extended:
+                filters += FILTER.pack(id | CAN_EFF_FLAG,
+                                       CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_EFF_MASK)
+            else:
+                filters += FILTER.pack(id,
+                                       CAN_EFF_FLAG | CAN_RTR_FLAG | CAN_SFF_MASK)
+
+        try:
+            self._sock.setsockopt(socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+                                  bytes(filters))
+            self._accept = None
+        except OSError:
+            self._accept = set((id, bool(extended)) for id, extended in ids)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def recv(self, id: int = None) -> CanMessage:
+        msg = self._take(id)
+        if msg is None:
+            # Nothing queued for this id, read whatever the socket has
+            self._fill(self._timeout)
+            msg = self._take(id)
+
+        return msg
+
+    def recvMany(self, timeout: float = None) -> list:
+        if not self._pending():
+            self._fill(self._timeout if timeout is None else timeout)
+
+        msgs = []
+        while 1:
+            msg = self._take(None)
+            if msg is None:
+                return msgs
+            msgs.append(msg)
+
+    def send(self, id: int, extended: bool, fd: bool, data) -> int:
+        size = self._pack(self._txBuffer, 0, id, extended, fd, data)
+        self._write(memoryview(self._txBuffer)[:size])
+
+        return len(data)
+
+    def sendMany(self, id: int, extended: bool, fd: bool, frames: list) -> int:
+        # There is no sendmmsg in the socket module, pack the burst into one
+        # buffer and write it out back to back
+        buffer = self._txBuffer
+        if len(buffer) < CANFD_MTU * len(frames):
+            buffer = self._txBuffer = bytearray(CANFD_MTU * len(frames))
+
+        view = memoryview(buffer)
+        offsets = []
+        offset = 0
+        for data in frames:
+            size = self._pack(buffer, offset, id, extended, fd, data)
+            offsets.append((offset, size))
+            offset += size
+
+        for offset, size in offsets:
+            self._write(view[offset: offset + size])
+
+        return len(frames)
+
+    def close(self):
+        self._sock.close()
+
+# private
+    def _pack(self, buffer, offset, id, extended, fd, data):
+        if extended:
+            id = (id & CAN_EFF_MASK) | CAN_EFF_FLAG
+        else:
+            id &= CAN_SFF_MASK
+
+        size = len(data)
+        fd = fd and self._fd
+        flags = CANFD_BRS if fd and self._bitrateSwitch else 0
+
+        FRAME_HEADER.pack_into(buffer, offset, id, size, flags, 0, 0)
+        start = offset + FRAME_HEADER.size
+        buffer[start: start + size] = data
+
+        mtu = CANFD_MTU if fd else CAN_MTU
+        end = offset + mtu
+        if start + size < end:
+            buffer[start + size: end] = bytes(end - start - size)
+
+        return mtu
+
+    def _write(self, frame):
+        while 1:
+            try:
+                self._sock.send(frame)
+                return
+            except BlockingIOError:
+                # TX queue full, wait until the driver drains it
+                select.select([], [self._sock], [], self._timeout)
+
+    def _fill(self, timeout):
+        if timeout:
+            readable, _, _ = select.select([self._sock], [], [], timeout)
+            if not readable:
+                return
+
+        # Drain what the kernel has queued in one go
+        for _ in range(self._batch):
+            buffer = self._rxBuffer if self._ring is None else self._ring.claim()
+
+            try:
+                nbytes, ancillary, _, _ = self._sock.recvmsg_into(
+                    [buffer], self._ancillarySize)
+            except BlockingIOError:
+                return
+
+            if nbytes < FRAME_HEADER.size:
+                continue
+
+            canId, size, flags, _, _ = FRAME_HEADER.unpack_from(buffer, 0)
+            if canId & CAN_ERR_FLAG:
+                continue
+
+            extended = bool(canId & CAN_EFF_FLAG)
+            id = canId & (CAN_EFF_MASK if extended else CAN_SFF_MASK)
+
+            if self._accept is not None and (id, extended) not in self._accept:
+                continue
+
+            timestamp = None
+            for level, type, value in ancillary:
+                if socket.SOL_SOCKET == level and SO_TIMESTAMPNS == type:
+                    sec, nsec = TIMESPEC.unpack_from(value)
+                    timestamp = sec + nsec / 1e9
+            if timestamp is None:
+                timestamp = time()
+
+            start = FRAME_HEADER.size
+            if self._ring is not None:
+                self._ring.commit(timestamp, id, extended, start, size,
+                                  CANFD_MTU == nbytes)
+                continue
+
+            self._queue(CanMessage(timestamp, id, extended,
+                                   bytes(buffer[start: start + size]),
+                                   CANFD_MTU == nbytes))
+
+    def _queue(self, msg):
+        queue = self._rx.get(msg.arbitrationId)
+        if queue is None:
+            queue = self._rx[msg.arbitrationId] = deque(maxlen=self._backlog)
+
+        if len(queue) == self._backlog:
+            # Oldest frame of this id is pushed out
+            self.dropped += 1
+
+        queue.append((self._arrival, msg))
+        self._arrival += 1
+
+    def _pending(self):
+        if self._ring is not None and len(self._ring):
+            return True
+
+        for queue in self._rx.values():
+            if queue:
+                return True
+
+        return False
+
+    def _take(self, id):
+        if None == id:
+            # Queued frames arrived before anything still in the ring
+            oldest = None
+            for queue in self._rx.values():
+                if queue and (oldest is None or queue[0][0] < oldest[0][0]):
+                    oldest = queue
+            if oldest is not None:
+                return oldest.popleft()[1]
+        else:
+            queue = self._rx.get(id)
+            if queue:
+                return queue.popleft()[1]
+
+        if self._ring is None:
+            return None
+
+        while 1:
+            msg = self._ring.get()
+            if msg is None or None == id or msg.arbitrationId == id:
+                return msg
+
+            # Frame for another id, copy it out of the ring before the record
+            # gets reused so a later recv() for that id still sees it
+            self._queue(CanMessage(msg.time, msg.arbitrationId, msg.isExtended,
+                                   bytes(msg.payload), msg.isFd))
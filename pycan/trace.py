@@ -0,0 +1,316 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from collections.abc import Callable
+from .datatypes import CanMessage
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+
+# File header: magic, version
+HEADER = struct.Struct('<8sH')
+MAGIC = b'PYCANTRC'
+VERSION = 2
+
+# Record header: timestamp, id, flags, data length
+RECORD = struct.Struct('<dIBB')
+
+FLAG_EXTENDED = 0x01
+FLAG_FD = 0x02
+FLAG_TX = 0x04
+
+# Trailer pointing at the index written on close
+TRAILER = struct.Struct('<8sQ')
+INDEX_MAGIC = b'PYCANIDX'
+
+
+class TraceRecorder(object):
+    def __init__(self,
+                 path: str,
+                 bufferSize: int = 1 << 20,
+                 clock: Callable[[], float] = monotonic):
+        self._file = open(path, 'wb', buffering=bufferSize)
+        self._file.write(HEADER.pack(MAGIC, VERSION))
+        self._position = HEADER.size
+
+        self._clock = clock
+        self._lock = Lock()
+        self._buffer = bytearray(RECORD.size + 64)
+
+        # Index, built as records are appended
+        self._offsets = array('Q')
+        self._ids = {}
+        self._times = array('d')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def record(self, msg: CanMessage, tx: bool = False):
+        self.write(msg.time, msg.arbitrationId, msg.isExtended, msg.isFd,
+                   msg.payload, tx)
+
+    def write(self, timestamp, id: int, extended: bool, fd: bool, data, tx: bool = False):
+        if timestamp is None:
+            timestamp = self._clock()
+
+        flags = ((FLAG_EXTENDED if extended else 0)
+                 | (FLAG_FD if fd else 0)
+                 | (FLAG_TX if tx else 0))
+        size = len(data)
+
+        with self._lock:
+            buffer = self._buffer
+            RECORD.pack_into(buffer, 0, timestamp, id, flags, size)
+            buffer[RECORD.size: RECORD.size + size] = data
+            self._file.write(memoryview(buffer)[:RECORD.size + size])
+
+            number = len(self._offsets)
+            self._offsets.append(self._position)
+            self._position += RECORD.size + size
+
+            records = self._ids.get((id, extended))
+            if records is None:
+                records = self._ids[(id, extended)] = array('I')
+            records.append(number)
+
+            _indexTime(self._times, timestamp)
+
+    def wrapRecv(self, recv: Callable[[int], CanMessage]) -> Callable[[int], CanMessage]:
+        def wrapper(id):
+            msg = recv(id)
+            if msg is not None:
+                # Same clock as the tx side, backends stamp with their own
+                self.write(None, msg.arbitrationId, msg.isExtended, msg.isFd,
+                           msg.payload)
+            return msg
+
+        return wrapper
+
+    def wrapSend(self, send: Callable[[int, bool, bool, bytearray], int]) -> Callable[[int, bool, bool, bytearray], int]:
+        def wrapper(id, extended, fd, data):
+            self.write(None, id, extended, fd, data, True)
+            return send(id, extended, fd, data)
+
+        return wrapper
+
+    def wrapSendMany(self, sendMany: Callable[[int, bool, bool, list], int]) -> Callable[[int, bool, bool, list], int]:
+        def wrapper(id, extended, fd, frames):
+            timestamp = self._clock()
+            for frame in frames:
+                self.write(timestamp, id, extended, fd, frame, True)
+            return sendMany(id, extended, fd, frames)
+
+        return wrapper
+
+    def close(self):
+        with self._lock:
+            if self._file.closed:
+                return
+
+            indexOffset = self._position
+            self._file.write(_packIndex(self._offsets, self._ids, self._times))
+            self._file.write(TRAILER.pack(INDEX_MAGIC, indexOffset))
+            self._file.close()
+
+
+class TraceReplayer(object):
+    def __init__(self, path: str):
+        self._fileObj = open(path, 'rb')
+        self._map = mmap.mmap(self._fileObj.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self._map, 0)
+        if MAGIC != magic or version > VERSION:
+            raise Exception("Not a pycan trace")
+
+        self._end = len(self._map)
+        index = self._loadIndex(version)
+        if index is None:
+            # Recording was not closed or has an older index, rebuild it with
+            # one scan
+            index = self._scan()
+
+        self._offsets, self._ids, self._times = index
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, number: int) -> CanMessage:
+        return self._read(self._offsets[number])[0]
+
+    def ids(self):
+        return list(self._ids.keys())
+
+    def isTx(self, number: int) -> bool:
+        return bool(self._map[self._offsets[number] + 12] & FLAG_TX)
+
+    def seekTime(self, timestamp: float) -> int:
+        # First record stamped at or after timestamp
+        return bisect_left(self._times, timestamp)
+
+    def seekId(self, id: int, extended: bool = False, start: int = 0) -> int:
+        records = self._ids.get((id, extended))
+        if not records:
+            return len(self._offsets)
+
+        i = bisect_left(records, start)
+        return records[i] if i < len(records) else len(self._offsets)
+
+    def frames(self, start: int = 0, stop: int = None, id: int = None, extended: bool = False):
+        if None == stop:
+            stop = len(self._offsets)
+
+        if id is None:
+            numbers = range(start, stop)
+        else:
+            records = self._ids.get((id, extended), ())
+            numbers = records[bisect_left(records, start): bisect_left(records, stop)]
+
+        for number in numbers:
+            yield self._read(self._offsets[number])[0]
+
+    def replay(self,
+               target: Callable[[CanMessage], object],
+               speed: float = 1.0,
+               start: int = 0,
+               stop: int = None,
+               tx: bool = False):
+        if None == stop:
+            stop = len(self._offsets)
+
+        origin = None
+        for number in range(start, stop):
+            msg, flags = self._read(self._offsets[number])
+
+            if flags & FLAG_TX and not tx:
+                continue
+
+            # speed None or 0 replays flat out
+            if speed:
+                if origin is None:
+                    origin = perf_counter() - msg.time / speed
+
+                delay = origin + msg.time / speed - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+
+            target(msg)
+
+    def close(self):
+        self._map.close()
+        self._fileObj.close()
+
+# private
+    def _read(self, offset):
+        timestamp, id, flags, size = RECORD.unpack_from(self._map, offset)
+        start = offset + RECORD.size
+        data = self._map[start: start + size]
+
+        return CanMessage(timestamp, id, bool(flags & FLAG_EXTENDED), data,
+                          bool(flags & FLAG_FD)), flags
+
+    def _loadIndex(self, version):
+        if self._end < HEADER.size + TRAILER.size:
+            return None
+
+        magic, indexOffset = TRAILER.unpack_from(self._map, self._end - TRAILER.size)
+        if INDEX_MAGIC != magic:
+            return None
+
+        self._end = indexOffset
+        if VERSION != version:
+            return None
+
+        return _unpackIndex(self._map, indexOffset)
+
+    def _scan(self):
+        offsets = array('Q')
+        ids = {}
+        times = array('d')
+
+        offset = HEADER.size
+        while offset + RECORD.size <= self._end:
+            timestamp, id, flags, size = RECORD.unpack_from(self._map, offset)
+            if offset + RECORD.size + size > self._end:
+                # Torn last record
+                break
+
+            number = len(offsets)
+            offsets.append(offset)
+
+            extended = bool(flags & FLAG_EXTENDED)
+            ids.setdefault((id, extended), array('I')).append(number)
+
+            _indexTime(times, timestamp)
+
+            offset += RECORD.size + size
+
+        return offsets, ids, times
+
+
+def _indexTime(times, timestamp):
+    # Running maximum, stays sorted for bisect even when tx and rx records
+    # land slightly out of order
+    if len(times) and times[-1] > timestamp:
+        timestamp = times[-1]
+    times.append(timestamp)
+
+
+def _packIndex(offsets, ids, times):
+    out = bytearray()
+
+    out += struct.pack('<Q', len(offsets))
+    out += offsets.tobytes()
+
+    out += struct.pack('<I', len(ids))
+    for (id, extended), records in ids.items():
+        out += struct.pack('<IBI', id, extended, len(records))
+        out += records.tobytes()
+
+    out += times.tobytes()
+
+    return out
+
+
+def _unpackIndex(buffer, offset):
+    count, = struct.unpack_from('<Q', buffer, offset)
+    offset += 8
+    offsets = array('Q', buffer[offset: offset + count * 8])
+    offset += count * 8
+
+    ids = {}
+    count, = struct.unpack_from('<I', buffer, offset)
+    offset += 4
+    for _ in range(count):
+        id, extended, n = struct.unpack_from('<IBI', buffer, offset)
+        offset += 9
+        ids[(id, bool(extended))] = array('I', buffer[offset: offset + n * 4])
+        offset += n * 4
+
+    times = array('d', buffer[offset: offset + len(offsets) * 8])
+
+    return offsets, ids, times
@@ -0,0 +1,235 @@
+# Copyright 2024 Yanujz
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import random
+from collections import deque
+from collections.abc import Callable
+from .datatypes import CanMessage
+from threading import Condition
+from time import perf_counter
+
+
+def frameBits(size: int, extended: bool = False, fd: bool = False,
+              stuffing: float = 1.0) -> tuple:
+    # Returns the bits sent at the nominal and at the data bit rate.
+    # `stuffing` scales the worst case number of dynamic stuff bits.
+    if not fd:
+        # SOF, id, RTR/SRR/IDE(/id ext/RTR), r0/r1, DLC, data, CRC
+        stuffable = (54 if extended else 34) + 8 * size
+        stuff = int((stuffable - 1) // 4 * stuffing)
+
+        # CRC delimiter, ACK slot + delimiter, EOF, intermission
+        return stuffable + stuff + 13, 0
+
+    # SOF, id, RRS/SRR/IDE(/id ext), FDF, res, BRS
+    arbitration = 36 if extended else 17
+    arbitrationStuff = int((arbitration - 1) // 4 * stuffing)
+
+    # ESI, DLC, data, stuff count, CRC with its fixed stuff bits
+    crc = 17 if size <= 16 else 21
+    data = 1 + 4 + 8 * size + 4 + crc + (4 + crc + 3) // 4
+    dataStuff = int((5 + 8 * size) // 4 * stuffing)
+
+    return arbitration + arbitrationStuff + 13, data + dataStuff
+
+
+def arbitrationKey(id: int, extended: bool) -> int:
+    # Lower wins: base id first, then a standard frame beats an extended one
+    # sharing its base id, then the id extension
+    if extended:
+        return ((id >> 18) << 19) | (1 << 18) | (id & 0x3FFFF)
+
+    return id << 19
+
+
+class VirtualBusNode(object):
+    def __init__(self, bus, receiveOwn: bool, timeout: float, ids, maxQueue: int):
+        self._bus = bus
+        self._receiveOwn = receiveOwn
+        self._timeout = timeout
+        # Acceptance filter like a controller's, None accepts every frame
+        self._accept = None if ids is None else set((id, bool(extended)) for id, extended in ids)
+        self._rx = deque(maxlen=maxQueue)
+        self._txPending = 0
+
+        self.dropped = 0
+
+    def recv(self, id: int = None) -> CanMessage:
+        return self._bus._recv(self, id, self._timeout)
+
+    def send(self, id: int, extended: bool, fd: bool, data) -> int:
+        self._bus._send(self, CanMessage(None, id, extended, bytes(data), fd))
+        return len(data)
+
+    def sendMany(self, id: int, extended: bool, fd: bool, frames: list) -> int:
+        for data in frames:
+            self._bus._send(self, CanMessage(None, id, extended, bytes(data), fd))
+        return len(frames)
+
+    def detach(self):
+        self._bus.detach(self)
+
+
+class VirtualBus(object):
+    def __init__(self,
+                 bitrate: int = 500000,
+                 dataBitrate: int = None,
+                 stuffing: float = 1.0,
+                 loss: float = 0.0,
+                 latency: float = 0.0,
+                 txQueue: int = 32,
+                 seed: int = None,
+                 clock: Callable[[], float] = perf_counter):
+        # bitrate None models an infinitely fast bus
+        self._bitrate = bitrate
+        self._dataBitrate = dataBitrate or bitrate
+        self._stuffing = stuffing
+        self._loss = loss
+        self._latency = latency
+        self._txQueue = txQueue
+        self._random = random.Random(seed)
+        self._clock = clock
+
+        self._cond = Condition()
+        self._nodes = []
+        self._seq = 0
+
+        # Frames waiting for arbitration: (key, seq, submitted, node, msg)
+        self._pending = []
+        # Frames on the wire: (delivery time, seq, node, msg)
+        self._inflight = deque()
+        self._busFree = 0
+
+        self.frames = 0
+        self.lost = 0
+        self.busyTime = 0
+        self.started = clock()
+
+    def attach(self,
+               receiveOwn: bool = False,
+               timeout: float = 0.01,
+               ids=None,
+               maxQueue: int = 1024) -> VirtualBusNode:
+        node = VirtualBusNode(self, receiveOwn, timeout, ids, maxQueue)
+        with self._cond:
+            self._nodes = self._nodes + [node]
+        return node
+
+    def detach(self, node: VirtualBusNode):
+        with self._cond:
+            self._nodes = [n for n in self._nodes if n is not node]
+
+    def frameTime(self, size: int, extended: bool = False, fd: bool = False) -> float:
+        if not self._bitrate:
+            return 0
+
+        nominal, data = frameBits(size, extended, fd, self._stuffing)
+        return nominal / self._bitrate + data / self._dataBitrate
+
+    def load(self) -> float:
+        elapsed = self._clock() - self.started
+        return self.busyTime / elapsed if elapsed > 0 else 0
+
+# private
+    def _send(self, node, msg):
+        with self._cond:
+            # A full TX queue blocks the sender, like a driver would
+            while node._txPending >= self._txQueue:
+                self._advance(self._clock())
+                if node._txPending >= self._txQueue:
+                    self._sleep(None)
+
+            now = self._clock()
+            self._seq += 1
+            self._pending.append((arbitrationKey(msg.arbitrationId, msg.isExtended),
+                                  self._seq, now, node, msg))
+            node._txPending += 1
+
+            self._advance(now)
+
+    def _recv(self, node, id, timeout):
+        with self._cond:
+            deadline = self._clock() + timeout
+            while 1:
+                now = self._clock()
+                self._advance(now)
+
+                for i, msg in enumerate(node._rx):
+                    if None == id or msg.arbitrationId == id:
+                        del node._rx[i]
+                        return msg
+
+                if now >= deadline:
+                    return None
+
+                self._sleep(deadline)
+
+    def _sleep(self, deadline):
+        # Wait for the next bus event or a notification from another node
+        now = self._clock()
+        wakeup = deadline
+        if self._inflight:
+            wakeup = self._inflight[0][0] if wakeup is None else min(wakeup, self._inflight[0][0])
+        if self._pending:
+            wakeup = self._busFree if wakeup is None else min(wakeup, self._busFree)
+
+        self._cond.wait(None if wakeup is None else max(0, wakeup - now))
+
+    def _advance(self, now):
+        notify = False
+
+        # Arbitrate every bus slot that started by now among the frames
+        # submitted by the time the slot began
+        while self._pending:
+            start = max(self._busFree, min(p[2] for p in self._pending))
+            if start > now:
+                break
+
+            winner = min((p for p in self._pending if p[2] <= start),
+                         key=lambda p: (p[0], p[1]))
+            self._pending.remove(winner)
+
+            _, seq, _, node, msg = winner
+            node._txPending -= 1
+            notify = True
+
+            duration = self.frameTime(len(msg.payload), msg.isExtended, msg.isFd)
+            end = start + duration
+            self._busFree = end
+            self.busyTime += duration
+            self.frames += 1
+
+            if self._loss and self._random.random() < self._loss:
+                self.lost += 1
+                continue
+
+            self._inflight.append((end + self._latency, seq, node, CanMessage(
+                end, msg.arbitrationId, msg.isExtended, msg.payload, msg.isFd)))
+
+        # Hand over the frames whose end of frame (plus latency) passed
+        while self._inflight and self._inflight[0][0] <= now:
+            _, _, sender, msg = self._inflight.popleft()
+            for node in self._nodes:
+                if node is sender and not node._receiveOwn:
+                    continue
+                if node._accept is not None and (msg.arbitrationId, msg.isExtended) not in node._accept:
+                    continue
+
+                if len(node._rx) == node._rx.maxlen:
+                    # Oldest unread frame is pushed out, like an RX FIFO overrun
+                    node.dropped += 1
+                node._rx.append(msg)
+            notify = True
+
+        if notify:
+            self._cond.notify_all()
@@ -10,6 +10,14 @@ setup(
     long_description_content_type='text/markdown',
     url='https://github.com/Yanujz/pycan',
     packages=find_packages(),
+    extras_require={
+        'numpy': ['numpy'],
+    },
+    entry_points={
+        'console_scripts': [
+            'pycan-bench = pycan.benchmark.__main__:main',
+        ],
+    },
     classifiers=[
         'Programming Language :: Python :: 3',
         'License :: OSI Approved :: MIT License',